@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# bench-mmp.py
+# Copyright (c) 2023 Tom Marble
+# See LICENSE for details.
+
+import argparse
+import io
+import os
+import os.path
+import random
+import sys
+import time
+import tracemalloc
+
+from typing import List, TextIO, Any, Callable, Tuple
+from attrs import define, field, validators
+from lark import Lark
+import mmp
+
+conditions: List[str] = [
+    'os == "linux"',
+    "os == 'mac' && os_version == '10.15'",
+    'debug',
+    '!debug',
+    'asan',
+    '(os == "win" && bits == 64) || tsan',
+    'processor == "x86_64"',
+    'verify',
+    'fission && !headless',
+    'os == "android" && android_version == "30"' ]
+
+@define
+class BenchMmp:
+    """
+    BenchMmp is the main class for the bench-mmp.py program:
+    generates synthetic manifests and times each phase of mmp.py on them.
+    """
+    argv: List[str] = field(validator=validators.deep_iterable(
+                                member_validator=validators.instance_of(type=str),
+                                iterable_validator=validators.instance_of(type=list)),
+                            default=['bench-mmp.py'])
+    comments: float = field(validator=validators.instance_of(type=float), default=0.2) # type: ignore
+    crlf: bool = field(validator=validators.instance_of(type=bool), default=False) # type: ignore
+    errfile: TextIO = field(default=sys.stderr)
+    keys: int = field(validator=validators.instance_of(type=int), default=4) # type: ignore
+    outfile: TextIO = field(default=sys.stdout)
+    prefs: int = field(validator=validators.instance_of(type=int), default=0) # type: ignore
+    repeat: int = field(validator=validators.instance_of(type=int), default=3) # type: ignore
+    sections: int = field(validator=validators.instance_of(type=int), default=100) # type: ignore
+    seed: int = field(validator=validators.instance_of(type=int), default=0) # type: ignore
+    skip_if: int = field(validator=validators.instance_of(type=int), default=3) # type: ignore
+    support_files: int = field(validator=validators.instance_of(type=int), default=5) # type: ignore
+    verbose: bool = field(validator=validators.instance_of(type=bool), default=False) # type: ignore
+
+    def out(self, a: Any, end: str = '\n') -> None:
+        "Print to outfile (STDOUT)"
+        print(a, file=self.outfile, end=end)
+
+    def err(self, a: Any) -> None:
+        "Print to error file (STDERR)"
+        print(a, file=self.errfile)
+
+    def verr(self, a: Any) -> None:
+        "Print to error file (STDERR) if in verbose mode"
+        if self.verbose:
+            self.err(a)
+
+    def run(self) -> int:
+        rc: int = 0
+        program: str = os.path.basename(p=sys.argv[0])
+        if len(self.argv) == 1:
+            if program == 'ipykernel_launcher.py': # running in vs code
+                program = 'bench-mmp.py'
+                self.argv = [program, '--help']
+            else:
+                self.argv = sys.argv
+        sys.argv = self.argv
+        parser = argparse.ArgumentParser('Benchmark Meta Manifest Parser')
+        # OPTIONS ----------------------------------------
+        parser.add_argument('-v', '--verbose',
+                            help='Prints details of each action',
+                            action='store_true', required=False)
+        parser.add_argument('-o', '--output-file',
+                            help='Write to file [STDOUT]',
+                            default=None, required=False)
+        parser.add_argument('-S', '--sections',
+                            help=f'Number of test sections (after DEFAULT) [{self.sections}]',
+                            type=int, default=self.sections, required=False)
+        parser.add_argument('-K', '--keys',
+                            help=f'Number of keys in each test section [{self.keys}]',
+                            type=int, default=self.keys, required=False)
+        parser.add_argument('-s', '--skip-if',
+                            help=f'Number of lines of each skip-if (and run-if, fail-if) key [{self.skip_if}]',
+                            type=int, default=self.skip_if, required=False)
+        parser.add_argument('-c', '--comments',
+                            help=f'Comment density: the fraction of lines with a comment [{self.comments}]',
+                            type=float, default=self.comments, required=False)
+        parser.add_argument('-p', '--prefs',
+                            help=f'Length of the prefs list in DEFAULT (0 for none) [{self.prefs}]',
+                            type=int, default=self.prefs, required=False)
+        parser.add_argument('-f', '--support-files',
+                            help=f'Length of each support-files list [{self.support_files}]',
+                            type=int, default=self.support_files, required=False)
+        parser.add_argument('-C', '--crlf',
+                            help='Use CRLF line endings (instead of LF)',
+                            action='store_true', required=False)
+        parser.add_argument('-r', '--repeat',
+                            help=f'Times each phase is run (the best time is reported) [{self.repeat}]',
+                            type=int, default=self.repeat, required=False)
+        parser.add_argument('-e', '--engine',
+                            help='Parser engine to benchmark: lalr, earley or both [both]',
+                            choices=['lalr', 'earley', 'both'], default='both', required=False)
+        parser.add_argument('-R', '--seed',
+                            help=f'Random seed for the generated manifest [{self.seed}]',
+                            type=int, default=self.seed, required=False)
+        # ACTIONS ----------------------------------------
+        parser.add_argument('-g', '--generate',
+                            help='ACTION: Write a synthetic manifest to this file',
+                            default=None, required=False)
+        parser.add_argument('-b', '--bench',
+                            help='ACTION: Benchmark mmp.py on a synthetic manifest (or on this ini file)',
+                            nargs='?', const='', default=None, required=False)
+        args: argparse.Namespace = parser.parse_args()
+        self.verbose = args.verbose
+        self.sections = args.sections
+        self.keys = args.keys
+        self.skip_if = args.skip_if
+        self.comments = args.comments
+        self.prefs = args.prefs
+        self.support_files = args.support_files
+        self.crlf = args.crlf
+        self.repeat = max(1, args.repeat)
+        self.seed = args.seed
+        if args.output_file:
+            self.outfile = open(file=args.output_file, mode='w')
+        if self.verbose:
+            self.err(f'sections: {self.sections}')
+            self.err(f'keys: {self.keys}')
+            self.err(f'skip-if: {self.skip_if}')
+            self.err(f'comments: {self.comments}')
+            self.err(f'prefs: {self.prefs}')
+            self.err(f'support-files: {self.support_files}')
+            self.err(f'crlf: {self.crlf}')
+            self.err(f'repeat: {self.repeat}')
+            self.err(f'engine: {args.engine}')
+            self.err(f'seed: {self.seed}')
+            self.err(f'output-file: {"STDOUT" if self.outfile == sys.stdout else args.output_file}')
+        if args.generate:
+            rc = 0 if self.write_manifest(args.generate) else 1
+        elif args.bench is not None:
+            engines: List[str] = ['lalr', 'earley'] if args.engine == 'both' else [args.engine]
+            rc = 0 if self.bench(args.bench, engines) else 1
+        else:
+            self.err('No action specified, see bench-mmp.py --help')
+            rc = 1
+        self.outfile.close()
+        return rc
+
+    def generate(self) -> str:
+        """
+        Returns a synthetic manifest (as from mozilla-central) with the
+        given number of sections, keys, skip-if lines, comments and lists
+        """
+        rng: random.Random = random.Random(self.seed)
+        bug: Callable[[], str] = lambda: f' # Bug {rng.randint(1000, 1999999)}' if rng.random() < self.comments else ''
+        lines: List[str] = ['[DEFAULT]']
+        if self.support_files > 0:
+            lines.append('support-files =')
+            lines += [f'  file_{i}.html' for i in range(self.support_files)]
+        if self.prefs > 0:
+            lines.append('prefs =')
+            lines += [f'  dom.pref_{i}.enabled=true' for i in range(self.prefs)]
+        lines.append(f'skip-if = {rng.choice(conditions)}{bug()}')
+        for s in range(self.sections):
+            if rng.random() < self.comments:
+                lines.append('')
+                lines.append(f'# test {s}')
+            lines.append(f'[test_{s}.html]')
+            for k in range(self.keys):
+                key: str = ['skip-if', 'support-files', 'run-if', 'tags', 'fail-if', 'reason'][k % 6]
+                if key.endswith('-if'):
+                    if self.skip_if == 1:
+                        lines.append(f'{key} = {rng.choice(conditions)}{bug()}')
+                    else:
+                        lines.append(f'{key} =')
+                        lines += [f'  {rng.choice(conditions)}{bug()}' for _ in range(self.skip_if)]
+                elif key == 'support-files':
+                    lines.append(f'{key} =')
+                    lines += [f'  data/test_{s}_{i}.js' for i in range(self.support_files)]
+                elif key == 'tags':
+                    lines.append(f'{key} = {rng.choice(["a11y", "webgl", "fission"])} {rng.choice(["os_integration", "remote"])}')
+                else:
+                    lines.append(f'{key} = "Bug {rng.randint(1000, 1999999)} is intermittent"')
+        newline: str = '\r\n' if self.crlf else '\n'
+        return newline.join(lines) + newline
+
+    def write_manifest(self, path: str) -> bool:
+        "Writes a synthetic manifest (see generate) to path"
+        try:
+            with open(file=path, mode='w', encoding='utf-8', newline='') as f:
+                f.write(self.generate())
+        except OSError as e:
+            self.err(f'cannot write {path}: {e}')
+            return False
+        return True
+
+    def measure(self, fn: Callable[[], Any]) -> Tuple[float, float, Any]:
+        """
+        Returns a tuple of (best seconds of repeat runs, peak MB, result) for fn
+        (the peak memory is measured with tracemalloc in one more run)
+        """
+        best: float = float('inf')
+        result: Any = None
+        for _ in range(self.repeat):
+            start: float = time.perf_counter()
+            result = fn()
+            best = min(best, time.perf_counter() - start)
+        tracemalloc.start()
+        fn()
+        (_, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return (best, peak / (1024 * 1024), result)
+
+    def report(self, phase: str, seconds: float, peak: float, text: str) -> None:
+        "Prints the time, throughput and peak memory of a phase"
+        lines: int = text.count('\n')
+        rate: str = f'{lines / seconds:12.0f} {len(text) / seconds / (1024 * 1024):8.2f}' if seconds > 0 and text else f'{"":12} {"":8}'
+        self.out(f'{phase:24} {seconds * 1000:10.1f} {rate} {peak:8.2f}')
+
+    def bench(self, ini_file: str, engines: List[str]) -> bool:
+        """
+        Times initialize_parser, building each parser, the Lark parse,
+        IRTransformer.transform and writing (pretty) the IR as INI and
+        TOML, on ini_file (or a synthetic manifest)
+        """
+        if ini_file:
+            m: mmp.MetaManifestParser = mmp.MetaManifestParser(cache=False)
+            text: str | None = m.read_binary_file_as_string(ini_file)
+            if text is None:
+                return False
+        else:
+            text = self.generate()
+        self.verr(f'manifest: {text.count(chr(10))} lines, {len(text)} characters')
+        self.out(f'{"phase":24} {"ms":>10} {"lines/s":>12} {"MB/s":>8} {"peak MB":>8}')
+        m = mmp.MetaManifestParser(cache=False, fix_implicit=True)
+        (seconds, peak, ok) = self.measure(m.initialize_parser)
+        if not ok:
+            return False
+        self.report('initialize_parser', seconds, peak, '')
+        for engine in engines:
+            def build() -> Lark | None:
+                mmp.parsers.clear()
+                return m.get_parser(engine)
+            (seconds, peak, parser) = self.measure(build)
+            if parser is None:
+                return False
+            self.report(f'{engine} build parser', seconds, peak, '')
+            (_, grammar) = m.parser_grammar(engine)
+            if engine == 'lalr': # time the parse without the inline IRTransformer
+                plain: Lark = Lark(grammar, parser='lalr', lexer='contextual', start='manifest')
+                try:
+                    (seconds, peak, _) = self.measure(lambda: parser.parse(text))
+                except Exception as e: # not in the LALR subset
+                    self.out(f'{engine + " parse (with IR)":24} failed: {type(e).__name__}')
+                    continue
+                self.report(f'{engine} parse (with IR)', seconds, peak, text)
+            else:
+                plain = parser
+            try:
+                (seconds, peak, tree) = self.measure(lambda: plain.parse(text))
+            except Exception as e: # not in the LALR subset
+                self.out(f'{engine + " parse":24} failed: {type(e).__name__}')
+                continue
+            self.report(f'{engine} parse', seconds, peak, text)
+            (seconds, peak, manifest) = self.measure(lambda: mmp.IRTransformer(True, m).transform(tree))
+            self.report(f'{engine} transform', seconds, peak, text)
+            for write_toml in (False, True):
+                emitter: mmp.Emitter = mmp.get_emitter(m, write_toml)
+                (seconds, peak, _) = self.measure(lambda: manifest.write_pretty([io.StringIO()], emitter))
+                self.report(f'{engine} pretty {"TOML" if write_toml else "INI"}', seconds, peak, text)
+        return True
+
+if __name__ == "__main__":
+    sys.exit(BenchMmp().run())
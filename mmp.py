@@ -4,16 +4,48 @@
 # See LICENSE for details.
 
 import argparse
+import ast
+import bisect
+import cProfile
+import fnmatch
+import functools
+import hashlib
+import heapq
+import json
 import os
 import os.path
+import pickle
 import re
+import shutil
+import signal
+import sqlite3
 import sys
-
-from typing import List, TextIO, Any, Pattern, Tuple, Dict
+import threading
+import time
+import tracemalloc
+
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, TextIO, Any, Pattern, Tuple, Dict, Set, Callable, Iterator
 from attrs import define, field, validators
-from lark import Lark, Transformer, Tree, Token
+import lark
+from lark import Lark, Transformer_NonRecursive, Tree, Token
 from lark import v_args # type: ignore
-from lark.exceptions import UnexpectedToken, GrammarError, ConfigurationError, UnexpectedCharacters
+from lark.exceptions import GrammarError, ConfigurationError, UnexpectedInput
+from lark.parsers.earley_forest import SymbolNode, PackedNode
+try:
+    import tomllib
+except ImportError: # Python < 3.11
+    tomllib = None # type: ignore
+try:
+    from manifestparser import ManifestParser # type: ignore
+except ImportError: # --verify will not compare the tests
+    ManifestParser = None
+try:
+    import numpy as np # type: ignore
+except ImportError: # --skip-matrix is not available
+    np = None
 
 
 array_keys = {
@@ -26,93 +58,581 @@ uq_keys = {
     'run-sequentially': True,
     'tags': True, }
 
+# compiled parsers kept for the life of the process (keyed by engine and grammar hash)
+parsers: Dict[str, Lark] = {}
+
+# include sections in an ini file
+include_rx: Pattern[str] = re.compile(r'\[include:([^\]]+)\]', re.MULTILINE)
+
+# MANIFESTS variables and quoted file names in a moz.build file
+manifests_rx: Pattern[str] = re.compile(r'([A-Z_]+MANIFESTS)', re.MULTILINE)
+manifest_file_rx: Pattern[str] = re.compile(r'\"([A-Za-z0-9/_.]+)\"', re.DOTALL)
+
+def moz_build_regex_refs(mb: str) -> List[List[str]]:
+    "Returns the [variable, filename] of each ini file in the MANIFESTS of moz.build (by regex)"
+    refs: List[List[str]] = []
+    start: int = 0
+    while start < len(mb):
+        m = manifests_rx.search(mb, start)
+        if not m:
+            break
+        (i, j) = m.span()
+        if i >= start:
+            title = mb[i:j]
+            tj = mb.find(']', j)
+            if tj < 0:
+                break
+            for file_m in manifest_file_rx.finditer(mb, j, tj+1):
+                filename: str = file_m.group(0)[1:-1]
+                if filename.endswith('.ini'):
+                    refs.append([title, filename])
+                j = tj
+        start = j + 1
+    return refs
+
+def moz_build_refs(mb: str) -> List[List[str]]:
+    """
+    Returns the [variable, filename] of each ini file assigned to a
+    MANIFESTS variable in moz.build (parsed as Python, or by regex
+    if it is not valid Python)
+    """
+    if mb.find('MANIFESTS') < 0:
+        return []
+    try:
+        tree: ast.Module = ast.parse(mb)
+    except (SyntaxError, ValueError):
+        return moz_build_regex_refs(mb)
+    refs: List[Tuple[int, int, str, str]] = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Assign):
+            targets: List[ast.expr] = node.targets
+        elif isinstance(node, (ast.AugAssign, ast.AnnAssign)):
+            targets = [node.target]
+        else:
+            continue
+        names: List[str] = [t.id for t in targets if isinstance(t, ast.Name) and manifests_rx.fullmatch(t.id)]
+        if not names or node.value is None:
+            continue
+        for value in ast.walk(node.value):
+            if isinstance(value, ast.Constant) and isinstance(value.value, str) and value.value.endswith('.ini'):
+                refs.append((value.lineno, value.col_offset, names[0], value.value))
+    return [[title, filename] for (_, _, title, filename) in sorted(refs)]
+
+def text_refs(path: str, text: str) -> Dict[str, Any]:
+    """
+    Returns {'sha', 'includes', 'refs'} for the text of path: the include
+    filenames of an ini file (or the [variable, filename] of a moz.build)
+    """
+    refs: Dict[str, Any] = {'sha': hashlib.sha256(text.encode('utf-8')).hexdigest(),
+                            'includes': False, 'refs': []}
+    if os.path.basename(path) == 'moz.build':
+        refs['refs'] = moz_build_refs(text)
+    else:
+        refs['includes'] = text.find('[include:') >= 0
+        refs['refs'] = [m.group(1) for m in include_rx.finditer(text)]
+    return refs
+
+def read_text_refs(fullpath: str, path: str) -> Dict[str, Any] | None:
+    "Returns the text_refs of the file (or None on error) in a --find-ini worker process"
+    try:
+        with open(file=fullpath, mode='r') as f:
+            text: str = f.read()
+    except (OSError, UnicodeDecodeError):
+        return None
+    return text_refs(path, text)
+
+# hash of this program (see program_digest)
+program_hash: str = ''
+
+def program_digest() -> str:
+    "Returns the hash of this program (which writes the output)"
+    global program_hash
+    if not program_hash:
+        with open(file=__file__, mode='rb') as f:
+            program_hash = hashlib.sha256(f.read()).hexdigest()
+    return program_hash
+
+# keys of DEFAULT which are concatenated with (instead of replaced by) the key of a test, as in manifestparser
+field_patterns: Dict[str, str] = {
+    'args': '%s %s',
+    'prefs': '%s %s',
+    'skip-if': '%s\n%s',
+    'support-files': '%s %s',
+}
+
+def combine_fields(defaults: Dict[str, str], values: Dict[str, str]) -> Dict[str, str]:
+    "Returns the effective values of a section with defaults (see field_patterns)"
+    combined: Dict[str, str] = dict(defaults)
+    for (key, value) in values.items():
+        combined[key] = field_patterns[key] % (defaults[key], value) if key in field_patterns and key in defaults else value
+    return combined
+
+# version of the resolve index (see MetaManifestParser.resolve), changed with the way tests are resolved
+resolve_version: int = 2
+
+# tables of the manifest store (see MetaManifestParser.update_store)
+store_schema: str = """
+DROP TABLE IF EXISTS meta;
+DROP TABLE IF EXISTS manifests;
+DROP TABLE IF EXISTS sections;
+DROP TABLE IF EXISTS entries;
+DROP TABLE IF EXISTS variables;
+CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE manifests (id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, sha TEXT NOT NULL,
+                        engine TEXT NOT NULL, status TEXT NOT NULL);
+CREATE TABLE sections (id INTEGER PRIMARY KEY, manifest INTEGER NOT NULL, name TEXT NOT NULL, position INTEGER NOT NULL);
+CREATE TABLE entries (id INTEGER PRIMARY KEY, section INTEGER NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL);
+CREATE TABLE variables (entry INTEGER NOT NULL, name TEXT NOT NULL);
+CREATE INDEX sections_manifest ON sections (manifest);
+CREATE INDEX sections_name ON sections (name);
+CREATE INDEX entries_section ON entries (section);
+CREATE INDEX entries_key ON entries (key);
+CREATE INDEX variables_entry ON variables (entry);
+CREATE INDEX variables_name ON variables (name);
+"""
+
+class CacheWriter:
+    """
+    Writes to a cache file, recording (instead of raising) the first error
+    so that the files written along with it are still written in full
+    """
+
+    def __init__(self, file: TextIO) -> None:
+        self.file: TextIO = file
+        self.error: OSError | None = None
+
+    def write(self, text: str) -> None:
+        if self.error is None:
+            try:
+                self.file.write(text)
+            except OSError as e:
+                self.error = e
+
+    def close(self) -> None:
+        if not self.file.closed:
+            try:
+                self.file.close()
+            except OSError as e:
+                self.error = self.error or e
+
+class ParserPickler(pickle.Pickler):
+    """
+    Pickles a compiled Lark parser (the re module is saved by reference)
+    """
+
+    def persistent_id(self, obj: Any) -> str | None:
+        if obj is re:
+            return 're'
+        return None
+
+class ParserUnpickler(pickle.Unpickler):
+    """
+    Restores a compiled Lark parser saved by ParserPickler
+    """
+
+    def persistent_load(self, pid: Any) -> Any:
+        if pid == 're':
+            return re
+        raise pickle.UnpicklingError(f'unsupported persistent id: {pid}')
+
+class ParseBudgetExceeded(Exception):
+    """
+    Raised (from a SIGALRM timer) when a parse takes more than
+    --max-parse-seconds or allocates more than --max-parse-mb
+    """
+
+class ExpressionError(Exception):
+    """
+    Raised when an mp_expr is not a manifestparser expression (or
+    cannot be evaluated with the given platform values)
+    """
+
 class IRToken(Token): # type: ignore
     """
-    Customization of Token class to support pretty printing
+    Customization of Token class for the IR (with no attributes beyond
+    those of Token, thus no __dict__)
     """
-    mmp: Any = None
+    __slots__ = ()
 
-    def __init__(self, type: str, value: str, mmp: Any) -> None:
+    def __init__(self, type: str, value: str) -> None:
         self.type = type
         self.value = value
-        self.mmp = mmp
 
     def __repr__(self):
         return 'IRToken(%r, %r)' % (self.type, self.value)
 
-    def pretty_basic_string(self) -> str:
-        return '"' + self + '"'
-
-    def pretty_literal_string(self) -> str:
-        return "'" + self + "'"
-
-    def pretty_ml_basic_string(self) -> str:
-        return '"""' + self + '"""'
-
-    def pretty_ml_literal_string(self) -> str:
-        return "'''" + self + "'''"
-
-    def pretty_mp_logical_implicit(self) -> str:
-        if self.mmp.write_toml and self.mmp.fix_implicit:
-            return str(self)
-        return ''
-
-    def pretty_unquoted_string(self) -> str:
-        if self.mmp.write_toml:
-            return '"' + self + '"'
-        return str(self)
-
-    def pretty_ws_unquoted_string_val(self) -> str:
-        v: str = str(self)
-        if len(v) > 0 and self.mmp.write_toml:
-            if v[0] == '#':
-                v = ' ' + v
-            return v.replace('\n', '')
-        return v
-
-    def pretty_prefs_quote(self) -> str:
-        if self.mmp.write_toml:
-            return str(self)
-        return ''
-
-    def pretty_ws_ini_newline(self) -> str:
-        value = str(self)
-        if self.mmp.write_toml:
-            value = value.replace('\n', '')
+@define
+class Emitter:
+    """
+    Writes the IR as INI or TOML (with or without the debug_expr parens and
+    fix_implicit disjunctions): dispatch tables of the handler for each
+    IRToken type and each IRTree data, built once for each configuration.
+    The IR is the same for both formats, the INI and TOML differences
+    (including the conversion of MP expression values) are made here
+    """
+    write_toml: bool = field(validator=validators.instance_of(type=bool), default=True) # type: ignore
+    debug_expr: bool = field(validator=validators.instance_of(type=bool), default=False) # type: ignore
+    fix_implicit: bool = field(validator=validators.instance_of(type=bool), default=False) # type: ignore
+    tokens: Dict[str, Callable[[Any], str]] = field(factory=dict)
+    trees: Dict[str, Callable[[Any, int, List[str]], None]] = field(factory=dict)
+
+    def __attrs_post_init__(self) -> None:
+        empty: Callable[[Any], str] = lambda t: ''
+        self.tokens = {
+            'basic_string': lambda t: '"' + t + '"',
+            'literal_string': lambda t: "'" + t + "'",
+            'ml_basic_string': lambda t: '"""' + t + '"""',
+            'ml_literal_string': lambda t: "'''" + t + "'''",
+            'ws_ignore': empty }
+        self.trees = {
+            'std_table': self.emit_table,
+            'mp_table': self.emit_table,
+            'array': self.emit_array,
+            'implicit_array': self.emit_implicit_array,
+            'array_values': self.emit_array_values,
+            'keyval': self.emit_keyval,
+            'mp_expr': self.emit_mp_expr if self.write_toml or self.debug_expr else self.emit_children }
+        if self.write_toml:
+            self.tokens.update({
+                'keyval_sep': lambda t: ' = ',
+                'mp_basic_string': lambda t: "'" + t + "'",
+                'mp_logical_implicit': str if self.fix_implicit else empty,
+                'unquoted_string': lambda t: '"' + t + '"',
+                'ws_indent': empty,
+                'ws_prefs': empty,
+                'ws_unquoted_string_val': self.toml_ws_unquoted_string_val,
+                'prefs_quote': str,
+                'ws_ini_newline': lambda t: str(t).replace('\n', '') })
+            self.trees.update({
+                'unquoted_string_val': self.emit_unquoted_string_val,
+                'keynoval': self.emit_keynoval })
+        else:
+            self.tokens.update({
+                'mp_basic_string': lambda t: '"' + t + '"',
+                'mp_logical_implicit': empty,
+                'prefs_quote': empty,
+                'toml_array_sep': empty })
+
+    def toml_ws_unquoted_string_val(self, token: Any) -> str:
+        v: str = str(token)
+        if len(v) > 0 and v[0] == '#':
+            v = ' ' + v
+        return v.replace('\n', '')
+
+    def emit(self, node: Any, level: int, out: List[str]) -> None:
+        "Appends the strings for node to out (a token without a handler is written as is)"
+        if isinstance(node, IRToken):
+            handler: Callable[[Any], str] | None = self.tokens.get(node.type)
+            out.append(node if handler is None else handler(node))
+        elif isinstance(node, ir_trees):
+            self.trees.get(node.data, self.emit_children)(node, level, out) # type: ignore
+        else:
+            raise TypeError(f'cannot write {node!r} (not in the IR)')
+
+    def emit_children(self, tree: Any, level: int, out: List[str]) -> None:
+        # self.emit inlined (this is called for most trees)
+        trees: Dict[str, Callable[[Any, int, List[str]], None]] = self.trees
+        tokens: Dict[str, Callable[[Any], str]] = self.tokens
+        emit_children: Callable[[Any, int, List[str]], None] = self.emit_children
+        for child in tree.children:
+            if isinstance(child, IRToken):
+                handler: Callable[[Any], str] | None = tokens.get(child.type)
+                out.append(child if handler is None else handler(child))
+            elif isinstance(child, ir_trees):
+                trees.get(child.data, emit_children)(child, level, out)
+            else:
+                raise TypeError(f'cannot write {child!r} (not in the IR)')
+
+    def emit_table(self, tree: Any, level: int, out: List[str]) -> None:
+        out.append('[')
+        if self.write_toml:
+            out.append('"' + self.table_key_string(tree.table_key) + '"')
+        else:
+            self.emit(tree.table_key, level, out)
+        out.append(']')
+
+    def emit_array(self, tree: Any, level: int, out: List[str]) -> None:
+        out.append('[')
+        self.emit_children(tree, level, out)
+        out.append(']')
+
+    def emit_implicit_array(self, tree: Any, level: int, out: List[str]) -> None:
+        if self.write_toml:
+            out.append('[')
+        one: bool = len(tree.children) == 1
+        if not one:
+            out.append('\n  ')
+        for child in tree.children:
+            self.emit(child, level, out)
+            if not one:
+                out.append(',')
+        if self.write_toml:
+            if not one:
+                out.append('\n')
+            out.append(']')
+
+    def emit_array_values(self, tree: Any, level: int, out: List[str]) -> None:
+        seen_val: bool = False
+        for child in tree.children:
+            if isinstance(child, ir_trees):
+                if seen_val:
+                    out.append(',')
+                self.emit(child, level, out)
+                if not self.write_toml: # TOML will handle array_sep explicitly
+                    seen_val = True
+            else:
+                out.append(f'{child}')
+
+    def emit_mp_expr(self, tree: Any, level: int, out: List[str]) -> None:
+        quote: bool = self.write_toml and level == 0
+        parens: bool = self.debug_expr and not (len(tree.children) == 1 and isinstance(tree.children[0], IRToken))
+        if quote:
+            out.append('"')
+        if parens:
+            out.append('(')
+        self.emit_children(tree, level + 1, out)
+        if parens:
+            out.append(')')
+        if quote:
+            out.append('"')
+
+    def emit_unquoted_string_val(self, tree: Any, level: int, out: List[str]) -> None:
+        out.append(' ') # write children in reverse order
+        for child in reversed(tree.children):
+            self.emit(child, level, out)
+
+    def emit_keynoval(self, tree: Any, level: int, out: List[str]) -> None:
+        self.emit_children(tree, level, out)
+        out.append(" '' # no value from INI") # set empty value for keys without a value
+
+    def emit_keyval(self, tree: Any, level: int, out: List[str]) -> None:
+        """
+        Converts a copy of an MP expression val (to an implicit_array,
+        unquoted_string or an array for *-if keys) as it is written
+        """
+        args: List[Any] = tree.children
+        key: str = ''
+        if isinstance(args[0], ir_trees) and args[0].data == 'key' and len(args[0].children) == 1 and isinstance(args[0].children[0], IRToken) and args[0].children[0].type == 'unquoted_key': # type: ignore
+            key = args[0].children[0] # type: ignore
+        should_not_be_mp_expr: bool = False
+        key_ends_in_if: bool = False
+        (should_not_be_mp_expr, key_ends_in_if) = self._val_should_not_be_mp_expr(key, args) # type: ignore
+        if should_not_be_mp_expr or key_ends_in_if:
+            args = list(args)
+            args[2] = copy_ir(args[2])
+        if should_not_be_mp_expr:
+            tree = self._convert_mp_expr(key, children=args)
+            if self._val_should_be_unquoted_string(tree.children): # type: ignore
+                tree = self._convert_unquoted_string(tree.children) # type: ignore
+        elif key_ends_in_if:
+            if isinstance(args[2].children[0], IRToken) and args[2].children[0].type == 'boolean': # type: ignore
+                # coerce boolean type to appear as basic_string
+                args[2].children[0].type = 'unquoted_key' # type: ignore
+            tree = self._mp_expr_to_array(args)
+        self.emit_children(tree, level, out)
+
+    def table_key_string(self, arg: Any) -> str:
+        "Returns the text of the table key arg (as one TOML basic_string)"
+        value: str = ''
+        if isinstance(arg, ir_trees):
+            for child in arg.children: # type: ignore
+                value += self.table_key_string(child)
+        else:
+            value += str(arg)
         return value
 
-    def _pretty(self, _level: int): # type: ignore
-        if self.type == 'basic_string':
-            yield self.pretty_basic_string()
-        elif self.type == 'literal_string':
-            yield self.pretty_literal_string()
-        elif self.type == 'ml_basic_string':
-            yield self.pretty_ml_basic_string()
-        elif self.type == 'ml_literal_string':
-            yield self.pretty_ml_literal_string()
-        elif self.type == 'mp_logical_implicit':
-            yield self.pretty_mp_logical_implicit()
-        elif self.type == 'unquoted_string':
-            yield self.pretty_unquoted_string()
-        elif self.type == 'ws_unquoted_string_val':
-            yield self.pretty_ws_unquoted_string_val()
-        elif self.type == 'ws_ini_newline':
-            yield self.pretty_ws_ini_newline()
-        elif self.type == 'prefs_quote':
-            yield self.pretty_prefs_quote()
-        elif self.type == 'ws_ignore':
-            pass
-        else: # self.type == 'unquoted_key':
-            yield str(self)
-
-class IRTree(Tree): # type: ignore
+
+    def _val_should_not_be_mp_expr(self, key: str, args: Tuple[Any]) -> Tuple[bool, bool]:
+        "Returns tuple of (should_not_be_mp_expr, key_ends_in_if)"
+        should_not_be_mp_expr: bool = False
+        key_ends_in_if: bool = False
+        if isinstance(args[2], IRTree) and args[2].data == 'val': # type: ignore
+            if len(args[2].children) == 1 and isinstance(args[2].children[0], IRTree) and args[2].children[0].data == 'mp_expr': # type: ignore
+                if key.endswith('-if'): # type: ignore
+                    key_ends_in_if = True
+                else:
+                    should_not_be_mp_expr = True # convert from mp_expr to unquoted_string or implicit_array
+            elif self.write_toml and key.endswith('-if') and len(args[2].children) == 1 and isinstance(args[2].children[0], IRToken) and args[2].children[0].type == 'boolean': # type: ignore
+                key_ends_in_if = True
+        return (should_not_be_mp_expr, key_ends_in_if)
+
+    def _convert_mp_expr(self, key: str, children: List[Any]) -> Tree[Any]:
+        values: List[IRTree] = [] # implicit_array_values
+        leading: List[Any] = [] # whitespace (and comments) before the next value
+        for item in mp_expr_walk(children[2].children, True):
+            if isinstance(item, IRToken):
+                if item.type != 'mp_logical_implicit':
+                    leading.append(item)
+                continue
+            values.append(IRTree('implicit_array_value', leading + self._mp_expr_value(item)))
+            leading = []
+        ia: IRTree = IRTree('implicit_array', values) # type: ignore
+        if self.write_toml and not key in uq_keys:
+            comments: str = ia._hoist_comments(ia.children[0].children, True, False) # type: ignore
+            if len(comments) > 0: # type: ignore
+                ia.children.append(IRToken('ws_comment_newline', comments + '\n'))
+        if len(ia.children) == 1 and key not in array_keys: # type: ignore
+            # singleton value
+            iav = ia.children[0]
+            first = key in uq_keys and self.write_toml
+            for child in iav.children: # type: ignore
+                if isinstance(child, IRToken):
+                    if child.type == 'alpha_unquoted_key': # type: ignore
+                        # unquoted keys need to be quoted in TOML values
+                        child.type = 'unquoted_string' # type: ignore
+                    elif child.type.startswith('ws'):
+                        if child.find('\n') >= 0:
+                            child.type = 'ws_ini_newline' # remove newlines for TOML
+                        elif first:
+                            child.type = 'ws_ignore' # remove leading whitespace
+                first = False
+            children[2].children = iav.children # type: ignore
+        else:
+            children[2].children = [ia]
+        keyval = IRTree('keyval', children)
+        return keyval
+
+    def _mp_expr_value(self, item: Tree[Any]) -> List[Any]:
+        """
+        Returns the children of the implicit_array_value for an expression of
+        an implicit OR: a token (prefixed with any "!"), a prefs_keyval (quoted)
+        or else the expression itself (such as a comparison)
+        """
+        value: List[Any] = []
+        nots: str = ''
+        node: Any = item
+        while len(node.children) == 2 and isinstance(node.children[0], IRToken) and isinstance(node.children[1], IRTree) \
+              and (node.children[0].type == 'mp_not' or node.children[0].type.startswith('ws_comment_newline')):
+            if node.children[0].type == 'mp_not':
+                nots += '!'
+            elif nots: # whitespace after a "!" is kept (in INI)
+                nots += '' if self.write_toml else str(node.children[0])
+            else:
+                value.append(node.children[0])
+            node = node.children[1]
+        if len(node.children) == 1 and isinstance(node.children[0], IRToken):
+            token: IRToken = node.children[0]
+            return value + [IRToken(token.type, nots + token) if nots else token] # type: ignore
+        if not nots and len(node.children) == 1 and isinstance(node.children[0], IRTree) and node.children[0].data == 'prefs_keyval':
+            prefs_keyval: IRTree = node.children[0] # type: ignore
+            return value + [prefs_keyval.children[0], # ws_prefs
+                            IRToken('prefs_quote', '"')] + prefs_keyval.children[1:4] + [IRToken('prefs_quote', '"')] # type: ignore
+        return [item]
+
+    def _mp_expr_to_array(self, children: List[Any]) -> Tree[Any]:
+        array_value: IRTree = IRTree('array_value', [])
+        array_values: IRTree = IRTree('array_values', [array_value])
+        array: IRTree = IRTree('array', [array_values])
+        for child in mp_expr_walk(children[2].children):
+            if isinstance(child, IRToken) and child.type == 'mp_logical_implicit':
+                continue # ignore
+            if isinstance(child, IRToken) and child.type.startswith('ws_comment_newline') and child.find('\n') >= 0:
+                if array_value.has_val: # type: ignore
+                    # prepare next new array value
+                    new_array_value = IRTree('array_value', []) # add comment to next array_value
+                    # move ending whitespace to new_array_value below
+                    while isinstance(array_value.children[-1], IRToken) and array_value.children[-1].type.startswith('ws'): # type: ignore
+                        new_array_value.children.append(array_value.children.pop()) # type: ignore
+                    self._promote_mp_expr(array_value)
+                    if self.write_toml:
+                        array_value.children.append(IRToken('array_sep', ',')) # type: ignore
+                    array_values.children.append(new_array_value)
+                    array_value = new_array_value
+            if not (isinstance(child, IRToken) and child.type.startswith('ws')):
+                array_value.has_val = True # type: ignore
+            array_value.children.append(child) # type: ignore
+        # handle the last array_value
+        if array_value.has_val: # type: ignore
+            self._promote_mp_expr(array_value)
+            if self.write_toml and len(array_values.children) > 1:
+                array_value.children.append(IRToken('array_sep', ',\n')) # type: ignore
+        if self.write_toml:
+            array_value = array_values.children[0]
+            comments: str = array_value._hoist_comments(array_value.children, True, False) # type: ignore
+            if len(comments) > 0: # type: ignore
+                array_value.children.append(IRToken('ws_comment_newline', comments + '\n'))
+            if len(array_values.children) > 1:
+                array_value.children.insert(0, IRToken('ws_comment_newline', '\n  '))
+        # setup val
+        children[2].children = [array]
+        keyval = IRTree('keyval', children)
+        return keyval
+
+    def _promote_mp_expr(self, array_value: Tree[Any]) -> None:
+        "Re-promotes all (non leading ws) array_value children to mp_expr"
+        mp_expr: IRTree = IRTree('mp_expr', [])
+        i: int = 0
+        while i < len(array_value.children) and isinstance(array_value.children[i], IRToken) and array_value.children[i].type.startswith('ws'): # type: ignore
+            i += 1
+        mp_expr.children = array_value.children[i:] # type: ignore
+        array_value.children = array_value.children[0:i] # type: ignore
+        array_value.children.append(mp_expr) # here is your ONE mp_expr per line
+
+    def _val_should_be_unquoted_string(self, args: Tuple[Any]) -> bool:
+        if isinstance(args[2], IRTree) and args[2].data == 'val': # type: ignore
+            if len(args[2].children) == 1 and isinstance(args[2].children[0], IRTree) and args[2].children[0].data == 'implicit_array': # type: ignore
+                if isinstance(args[0], ir_trees) and args[0].data == 'key' and len(args[0].children) == 1 and isinstance(args[0].children[0], IRToken) and args[0].children[0].type == 'unquoted_key' and args[0].children[0] in uq_keys: # type: ignore
+                    return True # convert from implicit_array to unquoted_string
+        return False
+
+    def _convert_unquoted_string(self, args: List[Any]) -> Tree[Any]:
+        ia = args[2].children[0] # type: ignore
+        unquoted_string = ''
+        unquoted_start = ''
+        for child in ia.children:
+            if unquoted_string is None:
+                break
+            if isinstance(child, IRTree) and child.data == 'implicit_array_value':
+                for token in child.children: # type: ignore
+                    if unquoted_string is None:
+                        break
+                    if isinstance(token, IRToken): # type: ignore
+                        if token.type == 'alpha_unquoted_key' or token.type == 'unquoted_string':
+                            unquoted_string += str(token)
+                        elif token.type.startswith('ws'):
+                            if len(unquoted_string) > 0:
+                                unquoted_string += str(token)
+                            elif not self.write_toml:
+                                unquoted_start = str(token)
+                        else:
+                            unquoted_string = None
+                    else:
+                        unquoted_string = None
+            else:
+                unquoted_string = None
+        if unquoted_string is not None:
+            args[2].children = [IRToken('ws_comment_newline1', unquoted_start),
+                                IRToken('unquoted_string', unquoted_string)] # type: ignore
+        return IRTree('keyval', list(args))
+
+# emitters for each configuration (see get_emitter)
+emitters: Dict[Tuple[bool, bool, bool], Emitter] = {}
+
+def get_emitter(mmp: Any, write_toml: bool | None = None) -> Emitter:
+    "Returns the Emitter for the output configuration of mmp (or as INI if not write_toml)"
+    if write_toml is None:
+        write_toml = mmp.write_toml
+    config: Tuple[bool, bool, bool] = (write_toml, mmp.debug_expr, mmp.fix_implicit)
+    if config not in emitters:
+        emitters[config] = Emitter(*config)
+    return emitters[config]
+
+class IRTree:
     """
-    Customization of Tree class to support pretty printing
+    Intermediate Representation tree (with data and children as for a lark
+    Tree, but with __slots__ instead of a __dict__ for each node).
+    The output configuration is given by the Emitter used to write it
     """
-    table_key: Any = None
-    mmp: Any = None
-    array_values: List[Any] = []
-    has_val: bool = False # used in _mp_expr_to_array to indicate array_value has a val
+    __slots__ = ('data', 'children', 'table_key', 'has_val')
+
+    def __init__(self, data: str, children: List[Any]) -> None:
+        self.data = data
+        self.children = children
+        self.table_key: Any = None
+        self.has_val: bool = False # used in _mp_expr_to_array to indicate array_value has a val
+
+    def __repr__(self):
+        return 'Tree(%r, %r)' % (self.data, self.children)
 
     def _hoist_comments(self, children: List[Any], remove_ws: bool=False, recurse: bool=True) -> str:
         """
@@ -145,84 +665,252 @@ class IRTree(Tree): # type: ignore
                             content += value[start:]
                         break
                 if content != value: # update child WITHOUT the comment
-                    children[c] = IRToken(child.type, content, self.mmp) # type: ignore
+                    children[c] = IRToken(child.type, content) # type: ignore
         return comments
 
-    def pretty_dotted_key(self, level: int, children: Any): # type: ignore
-        if self.mmp.write_toml:
-            yield '"'
-        for child in children: # type: ignore
-            yield from child._pretty(level) # type: ignore
-        if self.mmp.write_toml:
-            yield '"'
-
-    def pretty_mp_expr(self, level: int): # type: ignore
-        simple_token: bool = False
-        if self.mmp.write_toml and level == 0:
-            yield '"'
-        if len(self.children) == 1 and isinstance(self.children[0], IRToken): # type: ignore
-            simple_token = True
-        if self.mmp.debug_expr and not simple_token: # type: ignore
-            yield '('
-        for child in self.children: # type: ignore
-            yield from child._pretty(level + 1) # type: ignore
-        if self.mmp.debug_expr and not simple_token: # type: ignore
-            yield ')'
-        if self.mmp.write_toml and level == 0:
-            yield '"'
-
-    def pretty_array_values(self, level: int, values: Any): # type: ignore
-        seen_val: bool = False
-        for child in values: # type: ignore
-            if isinstance(child, Tree):
-                if seen_val:
-                    yield ','
-                yield from child._pretty(level) # type: ignore
-                if not self.mmp.write_toml: # TOML will handle array_sep explicitly
-                    seen_val = True
+    def pretty(self, emitter: Emitter) -> str:
+        "Returns the IR written by emitter"
+        out: List[str] = []
+        emitter.emit(self, 0, out)
+        return ''.join(out)
+
+    def write_pretty(self, files: List[TextIO], emitter: Emitter, end: str = '\n', buffer_size: int = 65536) -> None:
+        """
+        Writes pretty(emitter) followed by end to each file as it is generated
+        (in chunks of about buffer_size characters)
+        """
+        nodes: List[Any] = [self] if self.data in emitter.trees else self.children
+        out: List[str] = []
+        size: int = 0
+        for node in nodes:
+            n: int = len(out)
+            emitter.emit(node, 0, out)
+            size += sum(map(len, out[n:]))
+            if size >= buffer_size:
+                text: str = ''.join(out)
+                for f in files:
+                    f.write(text)
+                out = []
+                size = 0
+        out.append(end)
+        text = ''.join(out)
+        for f in files:
+            f.write(text)
+
+# IR trees (or lark Trees for rules without an IRTransformer method)
+ir_trees: Tuple[type, ...] = (IRTree, Tree)
+
+def copy_ir_node(node: Any) -> Any:
+    "Returns a copy of the IR node (a tree without its children)"
+    if isinstance(node, IRTree):
+        tree: IRTree = IRTree(node.data, [])
+        tree.table_key = node.table_key
+        tree.has_val = node.has_val
+        return tree
+    if isinstance(node, IRToken):
+        return IRToken(node.type, node.value)
+    return node
+
+def copy_ir(node: Any) -> Any:
+    "Returns a copy of the IR node (for the Emitter to convert as it is written)"
+    root: Any = copy_ir_node(node)
+    pending: List[Tuple[IRTree, IRTree]] = [(node, root)] if isinstance(node, IRTree) else []
+    while pending: # without recursion (an mp_expr may be nested once per line)
+        (tree, copy) = pending.pop()
+        for child in tree.children:
+            child_copy: Any = copy_ir_node(child)
+            copy.children.append(child_copy)
+            if isinstance(child, IRTree):
+                pending.append((child, child_copy))
+    return root
+
+# manifestparser expressions compiled by compile_mp_expr (keyed by expression text)
+compiled_exprs: Dict[str, Callable[[Dict[str, Any]], Any]] = {}
+compiled_vector_exprs: Dict[str, Callable[[Dict[str, Any]], Any]] = {}
+
+# tokens of an mp_expr which are not part of the expression
+mp_expr_ignored: Set[str] = {'comment', 'ws', 'ws_comment_newline', 'ws_comment_newline1', 'ws_prefs'}
+
+def mp_expr_walk(children: List[Any], items: bool = False) -> Iterator[Any]:
+    """
+    Yields the children of an mp_expr front to back, descending into each
+    mp_expr (or, if items, only into the mp_expr of an implicit OR or of
+    leading whitespace, so that each expression of the implicit OR is
+    yielded whole)
+    """
+    stack: List[Iterator[Any]] = [iter(children)]
+    while stack:
+        for node in stack[-1]:
+            if isinstance(node, IRTree) and node.data == 'mp_expr' and (not items or mp_expr_is_sequence(node)):
+                stack.append(iter(node.children))
+                break
+            yield node
+        else:
+            stack.pop()
+
+def mp_expr_is_sequence(node: IRTree) -> bool:
+    "Returns True if the mp_expr is an implicit OR, leading whitespace before an mp_expr or a single mp_expr"
+    first: Any = node.children[0]
+    if isinstance(first, IRToken):
+        return first.type.startswith('ws_comment_newline')
+    return len(node.children) == 1 and isinstance(first, IRTree) and first.data == 'mp_expr' \
+        or any([isinstance(c, IRToken) and c.type == 'mp_logical_implicit' for c in node.children])
+
+def mp_expr_parts(node: Any) -> List[Any]:
+    "Returns the children of the mp_expr node (as one list for a token) without whitespace and comments"
+    parts: List[Any] = [node]
+    while len(parts) == 1 and isinstance(parts[0], IRTree) and parts[0].data == 'mp_expr':
+        parts = [c for c in parts[0].children if not (isinstance(c, IRToken) and c.type in mp_expr_ignored)]
+    return parts
+
+def mp_expr_variables(node: Any) -> Set[str]:
+    "Returns the names of the variables referenced in the mp_expr node"
+    variables: Set[str] = set()
+    pending: List[Any] = [node]
+    while pending:
+        n: Any = pending.pop()
+        if isinstance(n, IRTree) and n.data != 'prefs_keyval':
+            pending += n.children
+        elif isinstance(n, IRToken) and n.type == 'alpha_unquoted_key' and str(n) not in ('true', 'false'):
+            variables.add(str(n))
+    return variables
+
+def mp_operand_python(token: Any) -> str:
+    "Returns the Python source for an mp_expr operand (a variable of v or a literal)"
+    if isinstance(token, IRToken):
+        if token.type == 'alpha_unquoted_key':
+            if token in ('true', 'false'):
+                return 'True' if token == 'true' else 'False'
+            return f'v.get({str(token)!r})'
+        if token.type == 'boolean':
+            return 'True' if token == 'true' else 'False'
+        if token.type == 'integer':
+            try:
+                return repr(int(str(token).replace('_', ''), 0))
+            except ValueError:
+                raise ExpressionError(f'not a manifestparser integer: {token!r}')
+        if token.type in ('mp_basic_string', 'basic_string', 'literal_string'):
+            return repr(str(token))
+    raise ExpressionError(f'not a manifestparser expression term: {token!r}')
+
+def mp_parts_python(parts: List[Any], vector: bool = False) -> str:
+    """
+    Returns the Python source for the parts of an mp_expr (see
+    mp_expr_parts): each && (and), || or implicit || (or) chain is one
+    flat Python expression, each comparison and ! is in parens.
+    If vector the variables are arrays (of the values in each
+    configuration) and !, && and || are the functions mp_not, mp_and
+    and mp_or (of the truth values, see mp_truth)
+    """
+    if len(parts) == 1:
+        return mp_operand_python(parts[0])
+    first: Any = parts[0]
+    if len(parts) == 2 and isinstance(first, IRToken) and first.type == 'mp_not':
+        operand: str = mp_parts_python(mp_expr_parts(parts[1]), vector)
+        return f'mp_not({operand})' if vector else f'(not {operand})'
+    if len(parts) == 3 and isinstance(first, IRToken) and first.type == 'lparen':
+        return f'({mp_parts_python(mp_expr_parts(parts[1]), vector)})'
+    op: Any = parts[1] if len(parts) == 3 else None
+    if isinstance(op, IRToken) and op.type == 'mp_op':
+        return f'({mp_parts_python(mp_expr_parts(parts[0]), vector)} {op} {mp_parts_python(mp_expr_parts(parts[2]), vector)})'
+    if isinstance(op, IRToken) and op.type in ('mp_logical', 'mp_logical_implicit'):
+        logical: str = 'and' if op == '&&' else 'or'
+        operands: List[List[Any]] = []
+        pending: List[List[Any]] = [parts]
+        while pending: # flatten the chain (without recursion)
+            p: List[Any] = pending.pop()
+            if len(p) == 3 and isinstance(p[1], IRToken) and p[1].type in ('mp_logical', 'mp_logical_implicit') and ('and' if p[1] == '&&' else 'or') == logical:
+                pending += [mp_expr_parts(p[2]), mp_expr_parts(p[0])]
             else:
-                yield f'{child}'
-
-    def _pretty(self, level: int, _indent_str: str = ''): # type: ignore
-        if self.data == 'std_table' or self.data == 'mp_table':
-            yield '['
-            yield from self.table_key._pretty(level) # type: ignore
-            yield ']'
-        elif self.data == 'array':
-            yield '['
-            for child in self.children: # type: ignore
-                yield from child._pretty(level) # type: ignore
-            yield ']'
-        elif self.data == 'implicit_array':
-            if self.mmp.write_toml:
-                yield '['
-            one: bool = len(self.children) == 1 # type: ignore
-            if not one:
-                yield '\n  '
-            for child in self.children: # type: ignore
-                yield from child._pretty(level) # type: ignore
-                if not one:
-                    yield ','
-            if self.mmp.write_toml:
-                if not one:
-                    yield '\n'
-                yield ']'
-        elif self.data == 'array_values':
-            yield from self.pretty_array_values(level, self.children) # type: ignore
-        elif self.data == 'mp_expr':
-            yield from self.pretty_mp_expr(level) # type: ignore
-        elif self.data == 'unquoted_string_val' and self.mmp.write_toml: # write children in reverse order
-            yield ' '
-            for child in reversed(self.children): # type: ignore
-                yield from child._pretty(level) # type: ignore
+                operands.append(p)
+        sources: List[str] = [mp_parts_python(p, vector) for p in operands]
+        if vector:
+            return f'mp_{logical}(' + ', '.join(sources) + ')'
+        return '(' + f' {logical} '.join(sources) + ')'
+    raise ExpressionError(f'not a manifestparser expression: {parts!r}')
+
+def mp_truth(value: Any) -> Any:
+    "Returns the truth value of an mp_expr value (a boolean array for an array of values)"
+    if isinstance(value, np.ndarray):
+        if value.dtype == np.bool_:
+            return value
+        if value.dtype.kind in 'iuf':
+            return value != 0
+        if value.dtype.kind == 'U':
+            return np.char.str_len(value) > 0
+        return np.frompyfunc(bool, 1, 1)(value).astype(np.bool_)
+    return bool(value)
+
+def mp_not(value: Any) -> Any:
+    return np.logical_not(mp_truth(value))
+
+def mp_and(*values: Any) -> Any:
+    return functools.reduce(np.logical_and, [mp_truth(v) for v in values])
+
+def mp_or(*values: Any) -> Any:
+    return functools.reduce(np.logical_or, [mp_truth(v) for v in values])
+
+def compile_mp_expr(text: str, node: Any, vector: bool = False) -> Callable[[Dict[str, Any]], Any]:
+    """
+    Returns a function of the platform values (a dict) which evaluates the
+    mp_expr node (with the text as written) as manifestparser would:
+    a variable which is not in the values is None, && and || (including an
+    implicit || between lines) return one of their operands. The function
+    is compiled once for each expression text.
+    If vector the function is of the values in each configuration (a dict
+    of arrays, see mp_columns) and returns an array of truth values
+    """
+    compiled: Dict[str, Callable[[Dict[str, Any]], Any]] = compiled_vector_exprs if vector else compiled_exprs
+    if text not in compiled:
+        source: str = 'lambda v: ' + mp_parts_python(mp_expr_parts(node), vector)
+        functions: Dict[str, Any] = {'mp_not': mp_not, 'mp_and': mp_and, 'mp_or': mp_or} if vector else {}
+        try:
+            compiled[text] = eval(compile(source, '<mp_expr>', 'eval'), {'__builtins__': {}, **functions})
+        except (SyntaxError, RecursionError, MemoryError) as e:
+            raise ExpressionError(f'cannot compile {text!r}: {e}')
+    return compiled[text]
+
+def evaluate_mp_expr(function: Callable[[Dict[str, Any]], Any], values: Dict[str, Any]) -> bool:
+    "Returns the value of the compiled expression function for the platform values"
+    try:
+        return bool(function(values))
+    except TypeError as e: # e.g. an ordering comparison with a missing variable
+        raise ExpressionError(str(e))
+
+def mp_columns(configurations: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Returns the values of each variable in the configurations as an array
+    (of booleans, integers or strings if all the configurations have a value
+    of that type, otherwise of objects with None for a missing value)
+    """
+    columns: Dict[str, Any] = {}
+    names: Set[str] = set()
+    for configuration in configurations:
+        names.update(configuration.keys())
+    for name in sorted(names):
+        values: List[Any] = [configuration.get(name) for configuration in configurations]
+        types: Set[type] = set([type(value) for value in values])
+        if types == {bool}:
+            columns[name] = np.array(values, dtype=np.bool_)
+        elif types == {int}:
+            columns[name] = np.array(values, dtype=np.int64)
+        elif types == {str}:
+            columns[name] = np.array(values, dtype=np.str_)
         else:
-            for child in self.children: # type: ignore
-                yield from child._pretty(level) # type: ignore
-        if self.data == 'keynoval' and self.mmp.write_toml:
-            yield " '' # no value from INI" # set empty value for keys without a value
+            column: Any = np.empty(len(values), dtype=object)
+            column[:] = values
+            columns[name] = column
+    return columns
+
+def evaluate_mp_expr_vector(function: Callable[[Dict[str, Any]], Any], columns: Dict[str, Any], n: int) -> Any:
+    "Returns the truth values (an array of n booleans) of the compiled vector expression function for the columns"
+    try:
+        return np.broadcast_to(mp_truth(function(columns)), (n,))
+    except TypeError as e: # e.g. an ordering comparison with a missing variable
+        raise ExpressionError(str(e))
 
 @v_args() # type: ignore
-class IRTransformer(Transformer): # type: ignore
+class IRTransformer(Transformer_NonRecursive): # type: ignore
     """
     Simplifies the parse tree into the IR
     """
@@ -238,22 +926,12 @@ class IRTransformer(Transformer): # type: ignore
                 rule = sys._getframe().f_code.co_name # type: ignore
             self.mmp.err(f'{rule}: {len(args)}')
             for i in range(len(args)):
-                if isinstance(args[i], Tree) and (args[i].data == 'std_table' or args[i].data == 'mp_table'):
+                if isinstance(args[i], ir_trees) and (args[i].data == 'std_table' or args[i].data == 'mp_table'):
                     self.mmp.err(f'  {i}: {args[i].__repr__()} [{args[i].table_key.__repr__()}] {type(args[i])}')
                 else:
                     self.mmp.err(f'  {i}: {args[i].__repr__()} {type(args[i])}')
-        if rule == 'expression':
-            self.mmp.err('')
-
-    def _mp_table_key(self, arg: Any) -> Token:
-        value: str = ''
-        if isinstance(arg, Tree):
-            for child in arg.children: # type: ignore
-                val = self._mp_table_key(child)
-                value += str(val)
-        else:
-            value += str(arg)
-        return IRToken('basic_string', value, self.mmp)
+            if rule == 'expression':
+                self.mmp.err('')
 
     def _token(self, args: Tuple[Any], value: str = '', debug: bool=True) -> Token:
         rule: str = sys._getframe(1).f_code.co_name # type: ignore
@@ -263,14 +941,14 @@ class IRTransformer(Transformer): # type: ignore
             if len(args) == 0:
                 return None # type: ignore
             value = str(args[0])
-        return IRToken(rule, value, self.mmp)
+        return IRToken(rule, value)
 
     def _token_combine(self, args: Tuple[Any], debug: bool=True) -> Token:
         rule: str = sys._getframe(1).f_code.co_name # type: ignore
         if debug:
             self._debug_args(args, rule)
         value: str = ''.join([token for token in args if token])
-        return IRToken(rule, value, self.mmp)
+        return IRToken(rule, value)
 
     def _remove_empty_children(self, args: Tuple[Any]) -> List[Any]:
         children = []
@@ -284,7 +962,7 @@ class IRTransformer(Transformer): # type: ignore
                     else:
                         children.append(arg) # type: ignore
                 else:
-                    children.append(IRToken(arg.type, str(arg), self.mmp)) # type: ignore
+                    children.append(IRToken(arg.type, str(arg))) # type: ignore
         return children # type: ignore
 
     def _tree(self, args: Tuple[Any], children: List[Any] | None = None) -> IRTree:
@@ -293,224 +971,8 @@ class IRTransformer(Transformer): # type: ignore
         if not children:
             children = self._remove_empty_children(args)
         tree = IRTree(rule, children)
-        tree.mmp = self.mmp
         return tree
 
-    def _val_should_not_be_mp_expr(self, key: str, args: Tuple[Any]) -> Tuple[bool, bool]:
-        "Returns tuple of (should_not_be_mp_expr, key_ends_in_if)"
-        should_not_be_mp_expr: bool = False
-        key_ends_in_if: bool = False
-        if isinstance(args[2], IRTree) and args[2].data == 'val': # type: ignore
-            if len(args[2].children) == 1 and isinstance(args[2].children[0], IRTree) and args[2].children[0].data == 'mp_expr': # type: ignore
-                if key.endswith('-if'): # type: ignore
-                    key_ends_in_if = True
-                    self.mmp.read_toml = False # we found a *-if keyval, thus we preserve the mp_expr
-                else:
-                    should_not_be_mp_expr = True # convert from mp_expr to unquoted_string or implicit_array
-            elif self.mmp.write_toml and key.endswith('-if') and len(args[2].children) == 1 and isinstance(args[2].children[0], IRToken) and args[2].children[0].type == 'boolean': # type: ignore
-                key_ends_in_if = True
-                # coerce boolean type to appear as basic_string
-                args[2].children[0].type = 'unquoted_key' # type: ignore
-        return (should_not_be_mp_expr, key_ends_in_if)
-
-    def _convert_mp_expr(self, key: str, children: List[Any], ia: Tree[Any] | None=None) -> Tree[Any]:
-        if ia == None:
-            ia = IRTree('implicit_array', [])
-            ia.mmp = self.mmp
-            ia = self._convert_mp_expr(key, children[2].children, ia) # type: ignore
-            if self.mmp.write_toml and not key in uq_keys:
-                comments: str = ia._hoist_comments(ia.children[0].children, True, False) # type: ignore
-                if len(comments) > 0: # type: ignore
-                    ia.children.append(IRToken('ws_comment_newline', comments + '\n', self.mmp))
-            if len(ia.children) == 1 and key not in array_keys: # type: ignore
-                # singleton value
-                iav = ia.children[0]
-                first = key in uq_keys and self.mmp.write_toml
-                for child in iav.children: # type: ignore
-                    if isinstance(child, IRToken):
-                        if child.type == 'alpha_unquoted_key': # type: ignore
-                            # unquoted keys need to be quoted in TOML values
-                            child.type = 'unquoted_string' # type: ignore
-                        elif child.type.startswith('ws'):
-                            if child.find('\n') >= 0:
-                                child.type = 'ws_ini_newline' # remove newlines for TOML
-                            elif first:
-                                child.type = 'ws_ignore' # remove leading whitespace
-                    first = False
-                children[2].children = iav.children # type: ignore
-            else:
-                children[2].children = [ia]
-            keyval = IRTree('keyval', children)
-            keyval.mmp = self.mmp
-            return keyval
-        iav = IRTree('implicit_array_value', [])
-        iav.mmp = self.mmp
-        if len(children) == 1 and isinstance(children[0], IRTree) and children[0].data == 'prefs_keyval': # type: ignore
-            # handle prefs_keyval
-            wschar: IRToken = children[0].children[0] # type: ignore
-            wschar.type = 'ws_comment_newline'
-            iav.children.append(wschar) # type: ignore
-            iav.children.append(IRToken('prefs_quote', '"', self.mmp)) # type: ignore
-            iav.children.append(children[0].children[1]) # type: ignore
-            iav.children.append(children[0].children[2]) # type: ignore
-            iav.children.append(children[0].children[3]) # type: ignore
-            iav.children.append(IRToken('prefs_quote', '"', self.mmp)) # type: ignore
-            ia.children.insert(0, iav)
-        elif len(children) == 1 and isinstance(children[0], IRToken):
-            # handle simple token
-            token: IRToken = children[0] # type: ignore
-            iav.children.append(token) # type: ignore
-            ia.children.insert(0, iav)
-        elif len(children) == 2 and isinstance(children[0], IRTree) and children[0].data == 'mp_not' and isinstance(children[1], IRToken): # type: ignore
-            # handle mp_not token
-            token: IRToken = children[1] # type: ignore
-            token = IRToken(token.type, '!' + token, self.mmp) # type: ignore
-            iav.children.append(token) # type: ignore
-            ia.children.insert(0, iav)
-        else:
-            # review the children in reverse order
-            for i in reversed(range(len(children))):
-                child = children[i]
-                if isinstance(child, IRTree):
-                    if child.data == 'mp_expr':
-                        ia = self._convert_mp_expr(key, child.children, ia) # type: ignore
-                    else:
-                        raise Exception(f'unexpected child of mp_expr: {child.__repr__()}')
-                elif child.type == 'mp_logical_implicit':
-                    pass # ignore
-                elif child.type.startswith('ws_comment_newline'):
-                    # add to the first iav
-                    if len(ia.children) > 0:
-                        iav = ia.children[0]
-                        iav.children.insert(0, child)
-                    else:
-                        raise Exception(f'unexpected token at the end of an mp_expr: {child.__repr__()}')
-                elif child.type == 'mp_not':
-                    # add to the first TOKEN in iav
-                    if len(ia.children) > 0:
-                        iav = ia.children[0]
-                        if len(iav.children) > 0 and isinstance(iav.children[0], IRToken):
-                            iav.children[0] = IRToken(iav.children[0].type, '!' + iav.children[0], self.mmp) # type: ignore
-                        else:
-                            raise Exception(f'unexpected mp_not at the end of an mp_expr: {child.__repr__()}')
-                    else:
-                        raise Exception(f'unexpected token at the end of an mp_expr: {child.__repr__()}')
-                else:
-                    raise Exception(f'unexpected token in mp_expr: {child.__repr__()}')
-        return ia # type: ignore
-
-    def _mp_expr_to_array(self, children: List[Any], array: Tree[Any] | None=None) -> Tree[Any]:
-        if array == None:
-            array_value = IRTree('array_value', [])
-            array_value.mmp = self.mmp
-            array_values = IRTree('array_values', [array_value])
-            array_values.mmp = self.mmp
-            array = IRTree('array', [array_values])
-            array.mmp = self.mmp
-            array = self._mp_expr_to_array(children[2].children, array) # type: ignore
-            # handle the last array_value
-            array_values = array.children[0]
-            array_value = array_values.children[-1]
-            if array_value.has_val: # type: ignore
-                # re-promote all (non leading ws) array_value children to mp_expr
-                mp_expr: IRTree = IRTree('mp_expr', [], None)
-                mp_expr.mmp = self.mmp
-                i: int = 0
-                while i < len(array_value.children) and isinstance(array_value.children[i], IRToken) and array_value.children[i].type.startswith('ws'): # type: ignore
-                    i += 1
-                mp_expr.children = array_value.children[i:] # type: ignore
-                array_value.children = array_value.children[0:i] # type: ignore
-                array_value.children.append(mp_expr) # here is your ONE mp_expr per line
-                if self.mmp.write_toml and len(array_values.children) > 1:
-                    array_value.children.append(IRToken('array_sep', ',\n', self.mmp)) # type: ignore
-            if self.mmp.write_toml:
-                array_value = array_values.children[0]
-                comments: str = array_value._hoist_comments(array_value.children, True, False) # type: ignore
-                if len(comments) > 0: # type: ignore
-                    array_value.children.append(IRToken('ws_comment_newline', comments + '\n', self.mmp))
-                if len(array_values.children) > 1:
-                    array_value.children.insert(0, IRToken('ws_comment_newline', '\n  ', self.mmp))
-            # setup val
-            children[2].children = [array]
-            keyval = IRTree('keyval', children)
-            keyval.mmp = self.mmp
-            return keyval
-        else:
-            for i in range(len(children)):
-                child = children[i]
-                if isinstance(child, IRTree):
-                    if child.data == 'mp_expr':
-                        array = self._mp_expr_to_array(child.children, array) # type: ignore
-                    else:
-                        raise Exception(f'unexpected child of mp_expr: {child.__repr__()}')
-                elif child.type == 'mp_logical_implicit':
-                    pass # ignore
-                else:
-                    array_values = array.children[0]
-                    array_value = array_values.children[-1]
-                    if child.type.startswith('ws_comment_newline') and child.find('\n') >= 0:
-                        if array_value.has_val: # type: ignore
-                            # prepare next new array value
-                            new_array_value = IRTree('array_value', []) # add comment to next array_value
-                            new_array_value.mmp = self.mmp
-                            # move ending whitespace to new_array_value below
-                            while isinstance(array_value.children[-1], IRToken) and array_value.children[-1].type.startswith('ws'): # type: ignore
-                                new_array_value.children.append(array_value.children.pop()) # type: ignore
-                            # re-promote all (non leading ws) array_value children to mp_expr
-                            mp_expr: IRTree = IRTree('mp_expr', [], None)
-                            mp_expr.mmp = self.mmp
-                            i: int = 0
-                            while i < len(array_value.children) and isinstance(array_value.children[i], IRToken) and array_value.children[i].type.startswith('ws'): # type: ignore
-                                i += 1
-                            mp_expr.children = array_value.children[i:] # type: ignore
-                            array_value.children = array_value.children[0:i] # type: ignore
-                            array_value.children.append(mp_expr) # here is your ONE mp_expr per line
-                            if self.mmp.write_toml:
-                                array_value.children.append(IRToken('array_sep', ',', self.mmp)) # type: ignore
-                            array_values.children.append(new_array_value)
-                            array_value = new_array_value
-                    if not child.type.startswith('ws'):
-                        array_value.has_val = True # type: ignore
-                    array_value.children.append(child) # type: ignore
-        return array # type: ignore
-
-    def _val_should_be_unquoted_string(self, args: Tuple[Any]) -> bool:
-        if isinstance(args[2], IRTree) and args[2].data == 'val': # type: ignore
-            if len(args[2].children) == 1 and isinstance(args[2].children[0], IRTree) and args[2].children[0].data == 'implicit_array': # type: ignore
-                if isinstance(args[0], Tree) and args[0].data == 'key' and len(args[0].children) == 1 and isinstance(args[0].children[0], IRToken) and args[0].children[0].type == 'unquoted_key' and args[0].children[0] in uq_keys: # type: ignore
-                    return True # convert from implicit_array to unquoted_string
-        return False
-
-    def _convert_unquoted_string(self, args: List[Any]) -> Tree[Any]:
-        ia = args[2].children[0] # type: ignore
-        unquoted_string = ''
-        unquoted_start = ''
-        for child in ia.children:
-            if unquoted_string is None:
-                break
-            if isinstance(child, IRTree) and child.data == 'implicit_array_value':
-                for token in child.children: # type: ignore
-                    if unquoted_string is None:
-                        break
-                    if isinstance(token, IRToken): # type: ignore
-                        if token.type == 'alpha_unquoted_key' or token.type == 'unquoted_string':
-                            unquoted_string += str(token)
-                        elif token.type.startswith('ws'):
-                            if len(unquoted_string) > 0:
-                                unquoted_string += str(token)
-                            elif not self.mmp.write_toml:
-                                unquoted_start = str(token)
-                        else:
-                            unquoted_string = None
-                    else:
-                        unquoted_string = None
-            else:
-                unquoted_string = None
-        if unquoted_string is not None:
-            args[2].children = [IRToken('ws_comment_newline1', unquoted_start, self.mmp),
-                                IRToken('unquoted_string', unquoted_string, self.mmp)] # type: ignore
-        return self._tree(args) # type: ignore
-
     def alpha(self, args: Tuple[Any]) -> Token:
         return self._token(args, '', False)
 
@@ -532,19 +994,12 @@ class IRTransformer(Transformer): # type: ignore
     def array_values(self, args: Tuple[Any]) -> Tree[Any]:
         rule: str = sys._getframe().f_code.co_name # type: ignore
         self._debug_args(args, rule)
-        array_values: Tree[Any] | None = None
-        if isinstance(args[-1], Tree) and args[-1].data == 'array_values': # type: ignore
-            array_values = args.pop() # type: ignore
-        else:
-            array_values = IRTree(rule, [], None)
-            array_values.mmp = self.mmp
-        if args[-1] is None or isinstance(args[-1], Token) and args[-1].type == 'array_sep': # type: ignore
-            args.pop() # type: ignore
-        array_value: IRTree = IRTree('array_value', self._remove_empty_children(args), None)
-        array_value.mmp = self.mmp
-        if self.mmp.write_toml:
-            array_value.children.append(IRToken('array_sep', ',', self.mmp)) # type: ignore
-        array_values.children.insert(0, array_value) # type: ignore
+        array_values: IRTree = IRTree(rule, [])
+        # each value is ws_comment_newline val ws_comment_newline [ array_sep ]
+        for i in range(0, len(args), 4):
+            array_value: IRTree = IRTree('array_value', self._remove_empty_children(args[i:i+3]))
+            array_value.children.append(IRToken('toml_array_sep', ',')) # type: ignore
+            array_values.children.append(array_value) # type: ignore
         return array_values # type: ignore
 
     def basic_char(self, args: Tuple[Any]) -> Token:
@@ -568,7 +1023,7 @@ class IRTransformer(Transformer): # type: ignore
         value: str = 'true'
         if len(args) == 1 and isinstance(args[0], Tree) and isinstance(args[0].data, Token):
             value = str(args[0].data)
-        return IRToken(rule, value, self.mmp)
+        return IRToken(rule, value)
 
     def colon(self, args: Tuple[Any]) -> Token:
         return self._token(args, ':', False)
@@ -598,15 +1053,6 @@ class IRTransformer(Transformer): # type: ignore
     def digit(self, args: Tuple[Any]) -> Token:
         return self._token(args, '', False)
 
-    def digit0_1(self, args: Tuple[Any]) -> Token:
-        return self._token(args, '', False)
-
-    def digit0_7(self, args: Tuple[Any]) -> Token:
-        return self._token(args, '', False)
-
-    def digit1_9(self, args: Tuple[Any]) -> Token:
-        return self._token(args, '', False)
-
     def dot(self, args: Tuple[Any]) -> Token:
         return self._token(args, '.', False)
 
@@ -640,19 +1086,9 @@ class IRTransformer(Transformer): # type: ignore
             value = '\\r'
         elif escape == 't':
             value = '\\t'
-        elif escape == 'x':
-            value = '\\x'
-            for i in range(2):
-                value += e.children[i+1] # type: ignore
-        elif escape == 'u':
-            value = '\\u'
-            for i in range(4):
-                value += e.children[i+1] # type: ignore
-        elif escape == 'U':
-            value = '\\U'
-            for i in range(8):
-                value += e.children[i+1] # type: ignore
-        return IRToken(rule, value, self.mmp)
+        elif escape == 'x' or escape == 'u' or escape == 'U':
+            value = '\\' + str(escape) + str(e.children[1]) # type: ignore
+        return IRToken(rule, value)
 
     def exp(self, args: Tuple[Any]) -> Token:
         return self._token_combine(args, False)
@@ -664,16 +1100,17 @@ class IRTransformer(Transformer): # type: ignore
         first = True
         for child in args:
             if child is not None:
-                if isinstance(child, Tree) or child.type == 'comment':
+                if isinstance(child, ir_trees) or child.type == 'comment':
                     children.append(child) # type: ignore
                 elif child.type.startswith('ws'):
-                    if len(child) > 0 and (not self.mmp.write_toml or not first):
+                    if len(child) > 0:
+                        if first:
+                            child.type = 'ws_indent' # not written as TOML
                         children.append(child) # type: ignore
             first = False
         if len(children) == 0: # type: ignore
             return None
-        tree: IRTree = IRTree('expression', children, None)
-        tree.mmp = self.mmp
+        tree: IRTree = IRTree('expression', children)
         return tree
 
     def float(self, args: Tuple[Any]) -> Token:
@@ -703,25 +1140,6 @@ class IRTransformer(Transformer): # type: ignore
     def hex_prefix(self, args: Tuple[Any]) -> Token:
         return self._token(args, '', False)
 
-    def implicit_array(self, args: Tuple[Any]) -> Tree[Any]:
-        rule: str = sys._getframe().f_code.co_name # type: ignore
-        self._debug_args(args, rule)
-        implicit_array: Tree[Any] | None = None
-        if isinstance(args[-1], Tree) and args[-1].data == 'implicit_array': # type: ignore
-            implicit_array = args.pop() # type: ignore
-        else:
-            implicit_array = IRTree(rule, [], None)
-            implicit_array.mmp = self.mmp
-            implicit_array_value1: IRTree = IRTree('implicit_array_value', list(args[2:4]), None)
-            implicit_array_value1.mmp = self.mmp
-            implicit_array.children.append(implicit_array_value1) # type: ignore
-            args.pop() # type: ignore
-            args.pop() # type: ignore
-        implicit_array_value0: IRTree = IRTree('implicit_array_value', list(args), None)
-        implicit_array_value0.mmp = self.mmp
-        implicit_array.children.insert(0, implicit_array_value0) # type: ignore
-        return implicit_array # type: ignore
-
     def integer(self, args: Tuple[Any]) -> Token:
         return self._token(args)
 
@@ -736,24 +1154,14 @@ class IRTransformer(Transformer): # type: ignore
         rule: str = sys._getframe().f_code.co_name # type: ignore
         self._debug_args(args, rule)
         key: str = ''
-        if isinstance(args[0], Tree) and args[0].data == 'key' and len(args[0].children) == 1 and isinstance(args[0].children[0], IRToken) and args[0].children[0].type == 'unquoted_key': # type: ignore
+        if isinstance(args[0], ir_trees) and args[0].data == 'key' and len(args[0].children) == 1 and isinstance(args[0].children[0], IRToken) and args[0].children[0].type == 'unquoted_key': # type: ignore
             key = args[0].children[0] # type: ignore
-        should_not_be_mp_expr: bool = False
-        key_ends_in_if: bool = False
-        (should_not_be_mp_expr, key_ends_in_if) = self._val_should_not_be_mp_expr(key, args)
-        if should_not_be_mp_expr:
-            tree = self._convert_mp_expr(key, children=list(args))
-            if self._val_should_be_unquoted_string(tree.children): # type: ignore
-                tree = self._convert_unquoted_string(tree.children) # type: ignore
-        elif key_ends_in_if:
-            tree = self._mp_expr_to_array(list(args))
-        else:
-            tree = self._tree(args=args)
-        return tree
+        if key.endswith('-if') and isinstance(args[2], IRTree) and args[2].data == 'val': # type: ignore
+            if len(args[2].children) == 1 and isinstance(args[2].children[0], IRTree) and args[2].children[0].data == 'mp_expr': # type: ignore
+                self.mmp.read_toml = False # we found a *-if keyval, thus we preserve the mp_expr
+        return self._tree(args=args) # the val is converted by the Emitter
 
     def keyval_sep(self, args: Tuple[Any]) -> Token:
-        if self.mmp.write_toml:
-            return IRToken('keyval_sep', ' = ', self.mmp)
         return self._token_combine(args, False)
 
     def literal_string(self, args: Tuple[Any]) -> Token:
@@ -781,8 +1189,7 @@ class IRTransformer(Transformer): # type: ignore
         for child in args:
             if child != None:
                 children.append(child)
-        tree: IRTree = IRTree(rule, children, None)
-        tree.mmp = self.mmp
+        tree: IRTree = IRTree(rule, children)
         return tree
 
     def minus(self, args: Tuple[Any]) -> Token:
@@ -827,12 +1234,11 @@ class IRTransformer(Transformer): # type: ignore
         self._debug_args(args, rule)
         # NOTE: will defer final type of mp_expr when resolved as a keyval
         # self.mmp.read_toml = False # Illegal TOML syntax found
-        tree: IRTree = IRTree(rule, [], None)
-        tree.mmp = self.mmp
-        if len(args) == 3 and isinstance(args[0], Tree) and args[0].data == 'mp_expr':
+        tree: IRTree = IRTree(rule, [])
+        if len(args) == 3 and isinstance(args[0], ir_trees) and args[0].data == 'mp_expr':
             # IMPLICIT OR
             tree.children = list(args)
-            tree.children.insert(1, IRToken('mp_logical_implicit', ' ||', self.mmp)) # type: ignore
+            tree.children.insert(1, IRToken('mp_logical_implicit', ' ||')) # type: ignore
         else:
             for arg in args:
                 if arg:
@@ -855,18 +1261,14 @@ class IRTransformer(Transformer): # type: ignore
         rule: str = sys._getframe().f_code.co_name # type: ignore
         self._debug_args(args, rule)
         self.mmp.read_toml = False # Illegal TOML syntax found
-        tree = IRTree(rule, [], None)
-        tree.mmp = self.mmp
-        if self.mmp.write_toml:
-            tree.table_key = self._mp_table_key(args[1]) # type: ignore
-        else:
-            tree.table_key = args[1] # type: ignore
+        tree = IRTree(rule, [])
+        tree.table_key = args[1] # type: ignore
         return tree
 
     def mp_terminal(self, args: Tuple[Any]) -> Tree[Any]:
         token = args[0]
-        if self.mmp.write_toml and token.type == 'basic_string':
-            token.type = 'literal_string'
+        if token.type == 'basic_string':
+            token.type = 'mp_basic_string' # written as a literal_string in TOML
         return token
 
     def newline(self, args: Tuple[Any]) -> Token:
@@ -889,8 +1291,7 @@ class IRTransformer(Transformer): # type: ignore
 
     def prefs_keyval(self, args: Tuple[Any]) -> Tree[Any]:
         children = list(args)
-        if self.mmp.write_toml: # convert WSCHAR to empty ws_comment_newline
-            children[0] = IRToken('ws_comment_newline', '', self.mmp)
+        children[0] = IRToken('ws_prefs', str(args[0])) # not written as TOML
         return self._tree(args, children) # explicitly preserve empty ws_comment_newline
 
     def rparen(self, args: Tuple[Any]) -> Token:
@@ -907,19 +1308,14 @@ class IRTransformer(Transformer): # type: ignore
     def std_table(self, args: Tuple[Any]) -> Tree[Any]:
         rule: str = sys._getframe().f_code.co_name # type: ignore
         self._debug_args(args, rule)
-        tree = IRTree(rule, [], None)
-        tree.mmp = self.mmp
+        tree = IRTree(rule, [])
         tree.table_key = args[1] # type: ignore
-        if self.mmp.write_toml:
-            tree.table_key = self._mp_table_key(args[1]) # type: ignore
-        else:
-            tree.table_key = args[1] # type: ignore
         return tree
 
     def string(self, args: Tuple[Any]) -> Token:
         rule: str = sys._getframe().f_code.co_name # type: ignore
         self._debug_args(args, rule)
-        return IRToken(args[0].type, str(args[0]), self.mmp) # preserve string type
+        return IRToken(args[0].type, str(args[0])) # preserve string type
 
     def time_delim(self, args: Tuple[Any]) -> Token:
         return self._token(args, '', False)
@@ -966,7 +1362,7 @@ class IRTransformer(Transformer): # type: ignore
     def unquoted_string_val(self, args: Tuple[Any]) -> Tree[any]: # type: ignore
         self.mmp.read_toml = False # Illegal TOML syntax found
         children: List[Any] = []
-        children.append(IRToken('ws_unquoted_string_val', str(args[0]), self.mmp))
+        children.append(IRToken('ws_unquoted_string_val', str(args[0])))
         children.append(args[1]) # type: ignore
         return self._tree(children) # type: ignore
 
@@ -991,6 +1387,108 @@ class IRTransformer(Transformer): # type: ignore
     def zero_prefixable_int(self, args: Tuple[Any]) -> Token:
         return self._token_combine(args, False)
 
+@define
+class IncludeGraph:
+    """
+    The graph of manifests (nodes) and the manifests they include (edges)
+    """
+    edges: Dict[str, List[str]] = field(factory=dict)
+    cycles: List[List[str]] = field(factory=list)
+    stack: List[str] = field(factory=list) # manifests being checked
+
+    def checked(self, path: str) -> bool:
+        """
+        Returns True if path has already been added (recording a cycle if
+        path is still being checked)
+        """
+        if path in self.stack:
+            self.cycles.append(self.stack[self.stack.index(path):] + [path])
+            return True
+        return path in self.edges
+
+    def add_node(self, path: str) -> None:
+        self.edges[path] = self.edges.get(path, [])
+
+    def add_edge(self, path: str, include_path: str) -> None:
+        self.add_node(path)
+        if include_path not in self.edges[path]:
+            self.edges[path].append(include_path)
+
+    def enter(self, path: str) -> None:
+        "Starts checking the includes of path"
+        self.add_node(path)
+        self.stack.append(path)
+
+    def leave(self, path: str) -> None:
+        "Finishes checking the includes of path"
+        self.stack.pop()
+
+    def nodes(self) -> List[str]:
+        "Returns all manifests (including those only included)"
+        nodes: Set[str] = set(self.edges.keys())
+        for includes in self.edges.values():
+            nodes.update(includes)
+        return sorted(nodes)
+
+    def topological_order(self) -> List[str]:
+        """
+        Returns the manifests with each included manifest before the
+        manifests which include it (manifests in a cycle are last)
+        """
+        nodes: List[str] = self.nodes()
+        pending: Dict[str, int] = {node: len(self.edges.get(node, [])) for node in nodes}
+        included_by: Dict[str, List[str]] = {node: [] for node in nodes}
+        for path, includes in self.edges.items():
+            for include_path in includes:
+                included_by[include_path].append(path)
+        ready: List[str] = [node for node in nodes if pending[node] == 0]
+        heapq.heapify(ready)
+        order: List[str] = []
+        while ready:
+            node: str = heapq.heappop(ready)
+            order.append(node)
+            for path in included_by[node]:
+                pending[path] -= 1
+                if pending[path] == 0:
+                    heapq.heappush(ready, path)
+        return order + [node for node in nodes if pending[node] > 0]
+
+    def groups(self) -> List[List[str]]:
+        """
+        Returns the groups of manifests connected by includes
+        (which must be converted together)
+        """
+        neighbors: Dict[str, Set[str]] = {node: set() for node in self.nodes()}
+        for path, includes in self.edges.items():
+            for include_path in includes:
+                neighbors[path].add(include_path)
+                neighbors[include_path].add(path)
+        groups: List[List[str]] = []
+        seen: Set[str] = set()
+        for node in neighbors:
+            if node in seen or not neighbors[node]:
+                continue
+            group: List[str] = []
+            todo: List[str] = [node]
+            seen.add(node)
+            while todo:
+                n: str = todo.pop()
+                group.append(n)
+                for m in neighbors[n]:
+                    if m not in seen:
+                        seen.add(m)
+                        todo.append(m)
+            groups.append(sorted(group))
+        return groups
+
+    def to_json(self) -> str:
+        "Returns the graph as JSON"
+        return json.dumps({'edges': {path: self.edges[path] for path in sorted(self.edges) if self.edges[path]},
+                           'cycles': self.cycles,
+                           'order': self.topological_order(),
+                           'groups': self.groups()}, indent=2)
+
+
 @define
 class MetaManifestParser:
     """
@@ -1000,18 +1498,42 @@ class MetaManifestParser:
                                 member_validator=validators.instance_of(type=str),
                                 iterable_validator=validators.instance_of(type=list)),
                             default=['mmp.py'])
+    build_dir: str = field(validator=validators.instance_of(type=str), # type: ignore
+                           default='') # type: ignore
+    cache: bool = field(validator=validators.instance_of(type=bool), default=True) # type: ignore
+    cache_bytes: int = field(validator=validators.instance_of(type=int), default=-1) # type: ignore
+    cache_size: int = field(validator=validators.instance_of(type=int), default=64) # type: ignore
+    cprofile_dir: str = field(validator=validators.instance_of(type=str), default='') # type: ignore
     debug_expr: bool = field(validator=validators.instance_of(type=bool), default=False) # type: ignore
+    engine: str = field(validator=validators.in_(['auto', 'lalr', 'earley']), default='auto') # type: ignore
     errfile: TextIO = field(default=sys.stderr)
+    find_index: Dict[str, Any] = field(default={}) # type: ignore
+    find_index_dirty: bool = field(validator=validators.instance_of(type=bool), default=False) # type: ignore
+    find_paths: Set[str] = field(default=set()) # type: ignore
+    resolve_index: Dict[str, Any] = field(factory=dict) # type: ignore
     fix_implicit: bool = field(validator=validators.instance_of(type=bool), default=False) # type: ignore
+    ignore_dirs: str = field(validator=validators.instance_of(type=str), # type: ignore
+                             default='.git,.hg,node_modules,obj-*')
     ignore_includes: bool = field(validator=validators.instance_of(type=bool), # type: ignore
                                   default=False)
+    ignore_rx: Pattern[str] = field(default=None)
+    include_graph: IncludeGraph = field(factory=IncludeGraph)
     ini_files: Dict[str, bool] = field(default={}) # type: ignore
     ir_ebnf: str = field(validator=validators.instance_of(type=str), # type: ignore
                          default='') # type: ignore
+    ir_lalr_ebnf: str = field(validator=validators.instance_of(type=str), # type: ignore
+                              default='') # type: ignore
+    jobs: int = field(validator=validators.instance_of(type=int), default=1) # type: ignore
+    keep_dotted: bool = field(validator=validators.instance_of(type=bool), default=False) # type: ignore
     match: str = field(default='(mochitest|chrome|a11y|browser|xpcshell)\x2Eini')
+    max_parse_mb: int = field(validator=validators.instance_of(type=int), default=0) # type: ignore
+    max_parse_seconds: float = field(validator=validators.instance_of(type=float), default=0.0) # type: ignore
     regex: Pattern[str] = field(default=None)
     read_toml: bool = field(validator=validators.instance_of(type=bool), default=True) # type: ignore
     outfile: TextIO = field(default=sys.stdout)
+    parsed_engine: str = field(validator=validators.instance_of(type=str), default='') # type: ignore
+    profile: Dict[str, Any] | None = field(default=None) # type: ignore
+    profile_file: str = field(validator=validators.instance_of(type=str), default='') # type: ignore
     topsrcdir: str = field(validator=validators.instance_of(type=str), # type: ignore
                            default='')
     verbose: bool = field(validator=validators.instance_of(type=bool), # type: ignore
@@ -1063,6 +1585,21 @@ class MetaManifestParser:
         topsrcdir: str = '.'
         if 'MOZILLA_CENTRAL' in os.environ:
             topsrcdir: str = os.environ['MOZILLA_CENTRAL']
+        parser.add_argument('-B', '--build-dir',
+                            help='Directory for cached files [MMP/build]',
+                            default='', required=False)
+        parser.add_argument('-M', '--moz-build-index',
+                            help='Write the moz.build (and variable) referencing each manifest found by --find-ini to this file',
+                            default=None, required=False)
+        parser.add_argument('-N', '--no-cache',
+                            help='Do not use (or write) the on-disk cache',
+                            action='store_true', required=False)
+        parser.add_argument('-C', '--cache-size',
+                            help='Maximum size of the conversion cache in MB [64]',
+                            type=int, default=64, required=False)
+        parser.add_argument('-e', '--engine',
+                            help='Parser engine: lalr with earley fallback (auto), lalr or earley [auto]',
+                            choices=['auto', 'lalr', 'earley'], default='auto', required=False)
         parser.add_argument('-D', '--debug-expr',
                             help='Add explicit parens around each MP expression',
                             action='store_true', required=False)
@@ -1072,12 +1609,27 @@ class MetaManifestParser:
         parser.add_argument('-t', '--topsrcdir',
                             help=f'Path to mozilla-central [{topsrcdir}]',
                             default=topsrcdir, required=False)
+        parser.add_argument('-s', '--skipped',
+                            help='File listing ini files (one per line) to skip with --verify',
+                            default=None, required=False)
         parser.add_argument('-T', '--strict-toml',
                             help='Will fail if input is not valid TOML',
                             action='store_true', required=False)
+        parser.add_argument('-I', '--ini-output-dir',
+                            help='With --batch also write the INI (from the same parse) to this directory',
+                            default=None, required=False)
+        parser.add_argument('-i', '--ignore-dirs',
+                            help=f'Comma separated directory names (or globs) not searched by --find-ini [{self.ignore_dirs}]',
+                            default=self.ignore_dirs, required=False)
+        parser.add_argument('-g', '--include-graph',
+                            help='Write the include graph found by --find-ini as JSON to this file',
+                            default=None, required=False)
         parser.add_argument('-j', '--ignore-includes',
                             help='Ignore ini files that include other ini files',
                             action='store_true', required=False)
+        parser.add_argument('-J', '--jobs',
+                            help='Number of worker processes for --batch (0 for one per CPU) [1]',
+                            type=int, default=1, required=False)
         parser.add_argument('-k', '--keep-dotted',
                             help='Preserve dotted keys in table names',
                             action='store_true', required=False)
@@ -1087,6 +1639,27 @@ class MetaManifestParser:
         parser.add_argument('-o', '--output-file',
                             help=f'Write to file [STDOUT]',
                             default=None, required=False)
+        parser.add_argument('-x', '--max-parse-seconds',
+                            help='Abort parsing a file after this many seconds (0 for no limit) [0]',
+                            type=float, default=0.0, required=False)
+        parser.add_argument('-X', '--max-parse-mb',
+                            help='Abort parsing a file after it allocates this many MB (0 for no limit) [0]',
+                            type=int, default=0, required=False)
+        parser.add_argument('-P', '--profile',
+                            help='Write the time and memory of each phase of reading each file as JSON lines to this file',
+                            default=None, required=False)
+        parser.add_argument('-c', '--cprofile',
+                            help='Write the cProfile stats of reading each file to this directory',
+                            default=None, required=False)
+        parser.add_argument('-p', '--platform',
+                            help='Platform values for --evaluate: a JSON file (as mozinfo.json) or comma separated name=value pairs (e.g. os=linux,debug=true,bits=64), for --skip-matrix a JSON list (or object) of configurations',
+                            default='', required=False)
+        parser.add_argument('-d', '--store',
+                            help='Manifest store (SQLite) for --update-store and --query [MMP/build/manifests-*.sqlite]',
+                            default='', required=False)
+        parser.add_argument('-O', '--output-dir',
+                            help=f'Write --batch output files to this directory [next to each input]',
+                            default=None, required=False)
         parser.add_argument('-W', '--write-ini',
                             help=f'Write as INI',
                             action='store_true', required=False)
@@ -1097,34 +1670,102 @@ class MetaManifestParser:
         parser.add_argument('-r', '--read-ini',
                             help=f'Read an ini file',
                             default=None, required=False)
+        parser.add_argument('-b', '--batch',
+                            help=f'Read each ini file listed in a file (as from --find-ini)',
+                            default=None, required=False)
+        parser.add_argument('-V', '--verify',
+                            help=f'Verify the INI round trip and TOML of each ini file listed in a file (as from --find-ini)',
+                            default=None, required=False)
+        parser.add_argument('-a', '--ambiguity',
+                            help=f'Report the ambiguous lines of an ini file (as parsed with ir.ebnf)',
+                            default=None, required=False)
+        parser.add_argument('-E', '--evaluate',
+                            help=f'Evaluate the *-if keys of each ini file listed in a file (as from --find-ini) for the --platform values',
+                            default=None, required=False)
+        parser.add_argument('-S', '--skip-matrix',
+                            help=f'Write which tests of each ini file listed in a file (as from --find-ini) are skipped in each --platform configuration (requires numpy)',
+                            default=None, required=False)
+        parser.add_argument('-U', '--update-store',
+                            help=f'Store the keys of each ini file listed in a file (as from --find-ini) in the --store (only reparsing the files which changed)',
+                            default=None, required=False)
+        parser.add_argument('-R', '--resolve',
+                            help=f'Write the effective values of each test (with the DEFAULT and include keys) of each ini file listed in a file (as from --find-ini)',
+                            default=None, required=False)
+        parser.add_argument('-q', '--query',
+                            help=f'Write the keys in the --store matching comma separated filters: test=, key=, variable=, file= and value= (which may be globs)',
+                            default=None, required=False)
         args: argparse.Namespace = parser.parse_args()
         self.verbose = args.verbose
+        self.build_dir = args.build_dir
+        self.cache = not args.no_cache
+        self.cache_size = args.cache_size
+        self.engine = args.engine
         self.ignore_includes = args.ignore_includes
         self.write_toml = not args.write_ini
         self.strict_toml = args.strict_toml
         self.debug_expr = args.debug_expr
         self.fix_implicit = args.fix_implicit
+        self.keep_dotted = args.keep_dotted
+        self.jobs = args.jobs if args.jobs > 0 else os.cpu_count() or 1
+        self.profile_file = args.profile or ''
+        self.max_parse_seconds = args.max_parse_seconds
+        self.max_parse_mb = args.max_parse_mb
+        self.cprofile_dir = args.cprofile or ''
         if args.output_file:
             self.outfile = open(file=args.output_file, mode='w')
+        if self.profile_file:
+            open(file=self.profile_file, mode='w').close() # each file is appended by read_ini
         if self.verbose:
             self.err(f'topsrcdir: {args.topsrcdir}')
+            self.err(f'ignore_dirs: {args.ignore_dirs}')
             self.err(f'ignore_includes: {self.ignore_includes}')
             self.err(f'match: {args.match}')
             self.err(f'output-file: {"STDOUT" if self.outfile == sys.stdout else args.output_file}')
+            self.err(f'output-dir: {args.output_dir}')
+            self.err(f'ini-output-dir: {args.ini_output_dir}')
             self.err(f'write-ini: {not self.write_toml}')
             self.err(f'strict-toml: {self.strict_toml}')
             self.err(f'debug-expr: {self.debug_expr}')
             self.err(f'fix-implicit: {self.fix_implicit}')
+            self.err(f'cache: {self.cache}')
+            self.err(f'cache-size: {self.cache_size}')
+            self.err(f'engine: {self.engine}')
+            self.err(f'jobs: {self.jobs}')
+            self.err(f'max-parse-seconds: {self.max_parse_seconds}')
+            self.err(f'max-parse-mb: {self.max_parse_mb}')
+            self.err(f'profile: {self.profile_file}')
+            self.err(f'cprofile: {self.cprofile_dir}')
+            self.err(f'platform: {args.platform}')
+            self.err(f'store: {args.store}')
         if not self.validate_topsrcdir(args.topsrcdir):
             self.err(f'topsrcdir invalid: "{args.topsrcdir}"')
             rc = 1
         elif not self.validate_match(args.match):
             self.err(f'match invalid: "{args.match}"')
             rc = 1
+        elif not self.validate_ignore_dirs(args.ignore_dirs):
+            self.err(f'ignore-dirs invalid: "{args.ignore_dirs}"')
+            rc = 1
         elif args.find_ini:
-            rc = 0 if self.find_ini() else 1
+            rc = 0 if self.find_ini(args.include_graph, args.moz_build_index) else 1
         elif args.read_ini:
             rc = 0 if self.initialize_parser() and self.read_ini(args.read_ini) else 1
+        elif args.batch:
+            rc = 0 if self.initialize_parser() and self.read_batch(args.batch, args.output_dir, args.ini_output_dir) else 1
+        elif args.verify:
+            rc = 0 if self.initialize_parser() and self.verify(args.verify, args.skipped) else 1
+        elif args.ambiguity:
+            rc = 0 if self.initialize_parser() and self.ambiguity_report(args.ambiguity) else 1
+        elif args.evaluate:
+            rc = 0 if self.initialize_parser() and self.evaluate(args.evaluate, args.platform) else 1
+        elif args.skip_matrix:
+            rc = 0 if self.initialize_parser() and self.skip_matrices(args.skip_matrix, args.platform) else 1
+        elif args.update_store:
+            rc = 0 if self.initialize_parser() and self.update_store(args.update_store, args.store) else 1
+        elif args.resolve:
+            rc = 0 if self.initialize_parser() and self.resolve(args.resolve) else 1
+        elif args.query:
+            rc = 0 if self.query_store(args.query, args.store) else 1
         else:
             self.err('No action specified, see mmp.py --help')
             rc = 1
@@ -1161,6 +1802,15 @@ class MetaManifestParser:
         self.regex = re.compile(match)
         return True
 
+    def validate_ignore_dirs(self, ignore_dirs: str) -> bool:
+        """
+        Compiles the comma separated directory names (or globs) to ignore
+        """
+        self.ignore_dirs = ignore_dirs
+        patterns: List[str] = [fnmatch.translate(d.strip()) for d in ignore_dirs.split(',') if d.strip()]
+        self.ignore_rx = re.compile('|'.join(patterns) if patterns else '(?!)')
+        return True
+
     def read_binary_file_as_string(self, fullpath: str) -> str | None:
         """
         Returns contents of the file as a string (or None on error)
@@ -1193,38 +1843,160 @@ class MetaManifestParser:
         file.close()
         return text
 
+    def load_find_index(self) -> None:
+        """
+        Loads the discovery index for topsrcdir from the build directory
+        (an index written by a different version of mmp.py is ignored)
+        """
+        self.find_index = {}
+        self.find_index_dirty = False
+        if not self.cache:
+            return
+        try:
+            with open(file=self.find_index_path(), mode='r', encoding='utf-8') as f:
+                index: Dict[str, Any] = json.load(f)
+        except (OSError, ValueError):
+            return
+        if index.get('program') == program_digest() and index.get('topsrcdir') == self.topsrcdir:
+            self.find_index = index['files']
+            self.verr(f'loaded discovery index: {self.find_index_path()}')
+
+    def save_find_index(self, paths: Set[str]) -> None:
+        """
+        Saves the discovery index entries for paths (if anything changed)
+        """
+        if not self.cache or (not self.find_index_dirty and len(paths) == len(self.find_index)):
+            return
+        index: Dict[str, Any] = {'program': program_digest(), 'topsrcdir': self.topsrcdir,
+                                 'files': {p: self.find_index[p] for p in sorted(paths) if p in self.find_index}}
+        index_path: str = self.find_index_path()
+        try:
+            os.makedirs(self.build_dir, exist_ok=True)
+            tmp_path: str = f'{index_path}.{os.getpid()}.tmp'
+            with open(file=tmp_path, mode='w', encoding='utf-8') as f:
+                json.dump(index, f)
+            os.replace(tmp_path, index_path)
+        except OSError as e:
+            self.verr(f'cannot save discovery index {index_path}: {e}')
+            return
+        self.verr(f'saved discovery index: {index_path}')
+
+    def find_index_path(self) -> str:
+        "Returns the path of the discovery index for topsrcdir"
+        h: str = hashlib.sha256(self.topsrcdir.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.build_dir, f'find-ini-{h}.json')
+
+    def file_stat(self, path: str) -> Tuple[os.stat_result | None, bool]:
+        """
+        Returns a tuple of (stat, True if the discovery index entry
+        for path is up to date) for path (relative to topsrcdir)
+        """
+        try:
+            st: os.stat_result | None = os.stat(os.path.join(self.topsrcdir, path))
+        except OSError:
+            return (None, False)
+        entry: Dict[str, Any] | None = self.find_index.get(path)
+        fresh: bool = entry is not None and entry['mtime'] == st.st_mtime_ns \
+            and entry['size'] == st.st_size and entry['ino'] == st.st_ino
+        return (st, fresh)
+
+    def index_file_refs(self, path: str, st: os.stat_result | None, refs: Dict[str, Any]) -> Dict[str, Any]:
+        "Returns the discovery index entry for path with refs (saved if path exists)"
+        entry: Dict[str, Any] = {'mtime': st.st_mtime_ns if st else 0, 'size': st.st_size if st else 0,
+                                 'ino': st.st_ino if st else 0}
+        entry.update(refs)
+        if st is not None:
+            self.find_index[path] = entry
+            self.find_index_dirty = True
+        return entry
+
+    def file_refs(self, path: str) -> Dict[str, Any]:
+        """
+        Returns the discovery index entry for path (relative to topsrcdir):
+        {'mtime', 'size', 'ino', 'sha', 'includes', 'refs'} where refs are
+        the include filenames of an ini file (or the [variable, filename] of
+        the ini files in a moz.build), or None if the file cannot be read.
+        The file is only read if its stat changed since it was indexed
+        (and only parsed if its hash changed)
+        """
+        (st, fresh) = self.file_stat(path)
+        if fresh:
+            return self.find_index[path]
+        text: str | None = self.read_file_as_string(os.path.join(self.topsrcdir, path))
+        if text == None:
+            return self.index_file_refs(path, st, {'sha': '', 'includes': False, 'refs': None})
+        entry: Dict[str, Any] | None = self.find_index.get(path)
+        sha: str = hashlib.sha256(text.encode('utf-8')).hexdigest() # type: ignore
+        if entry is not None and entry['sha'] == sha:
+            refs: Dict[str, Any] = {'sha': sha, 'includes': entry['includes'], 'refs': entry['refs']}
+        else:
+            refs = text_refs(path, text) # type: ignore
+        return self.index_file_refs(path, st, refs)
+
+    def prefetch_file_refs(self, paths: List[str]) -> None:
+        """
+        Reads the files which are not up to date in the discovery index
+        with --jobs worker processes
+        """
+        stale: List[Tuple[str, os.stat_result]] = []
+        for path in paths:
+            (st, fresh) = self.file_stat(path)
+            if st is not None and not fresh:
+                stale.append((path, st))
+        if self.jobs == 1 or len(stale) < 2:
+            return # file_refs will read them as needed
+        self.verr(f'reading {len(stale)} files with {self.jobs} jobs')
+        with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+            fullpaths: List[str] = [os.path.join(self.topsrcdir, path) for (path, _) in stale]
+            paths = [path for (path, _) in stale]
+            for (path, st), refs in zip(stale, executor.map(read_text_refs, fullpaths, paths, chunksize=16)):
+                if refs is not None: # else file_refs will report the error
+                    self.index_file_refs(path, st, refs)
+
+    def moz_build_index(self) -> List[Tuple[str, str, str, str]]:
+        """
+        Returns the sorted (manifest, moz.build, variable, filename) for each
+        ini file referenced by the moz.build files checked by find_ini
+        """
+        index: List[Tuple[str, str, str, str]] = []
+        for path in self.find_paths:
+            entry: Dict[str, Any] | None = self.find_index.get(path)
+            if os.path.basename(path) == 'moz.build' and entry is not None and entry['refs']:
+                for (title, filename) in entry['refs']:
+                    index.append((os.path.join(os.path.dirname(path), filename), path, title, filename))
+        return sorted(index)
+
+    def include_path(self, path: str, include_filename: str) -> str:
+        "Returns the path (relative to topsrcdir) of the file included by path"
+        include_path: str = os.path.join(self.topsrcdir, os.path.dirname(path), include_filename)
+        include_path = os.path.realpath(include_path)
+        return '.' + include_path[len(os.path.realpath(self.topsrcdir)):] # make path relative
+
     def check_for_includes(self, path: str, indent: int=0) -> None:
         """
         Prints fullpath if it includes a section `[include`
-        Then recursively follows include path.
+        Then recursively follows include path (adding it to the include_graph).
         """
-        if path in self.ini_files and self.ini_files[path]:
-            return # already checked
-        ini: str | None = self.read_file_as_string(os.path.join(self.topsrcdir, path))
-        if ini == None:
+        if self.include_graph.checked(path):
+            return # already checked (or an include cycle)
+        self.find_paths.add(path)
+        entry: Dict[str, Any] = self.file_refs(path)
+        if entry['refs'] is None:
             return
         pad = '  ' * indent
-        if ini.find('[include:') >= 0:
+        if entry['includes']:
             self.ini_files[path] = self.ini_files.get(path, False)
             self.verr(f'{pad}INCLUDES found in {path}:')
-            regex = '\\[include:([^\\]]+)\\]'
-            rx = re.compile(regex, re.MULTILINE)
-            start: int = 0
-            while start < len(ini):
-                m = rx.search(ini, start)
-                if m:
-                    (i, j) = m.span()
-                    if i >= start:
-                        include_filename = ini[i+9:j-1]
-                        self.verr(f'{pad}INCLUDE={include_filename}=')
-                        include_path = os.path.join(os.path.dirname(path), include_filename)
-                        include_path = os.path.realpath(include_path)
-                        include_path = '.' + include_path[len(self.topsrcdir):] # make path relative
-                        self.ini_files[include_path] = self.ini_files.get(include_path, False)
-                        self.check_for_includes(include_path, indent+1)
-                    start = j + 1
-                else:
-                    break
+            self.include_graph.enter(path)
+            for include_filename in entry['refs']:
+                self.verr(f'{pad}INCLUDE={include_filename}=')
+                include_path = self.include_path(path, include_filename)
+                self.ini_files[include_path] = self.ini_files.get(include_path, False)
+                self.include_graph.add_edge(path, include_path)
+                self.check_for_includes(include_path, indent+1)
+            self.include_graph.leave(path)
+        else:
+            self.include_graph.add_node(path)
         if path in self.ini_files:
             self.ini_files[path] = True
 
@@ -1232,63 +2004,100 @@ class MetaManifestParser:
         """
         Checks moz.build for OTHER INI files
         """
-        mb: str | None = self.read_file_as_string(os.path.join(self.topsrcdir, path))
-        if mb == None:
+        self.find_paths.add(path)
+        entry: Dict[str, Any] = self.file_refs(path)
+        if not entry['refs']:
             return
-        if mb.find('MANIFESTS') >= 0:
-            self.verr(f'MOZ.BUILD={path}=')
-            regex = r'([A-Z_]+MANIFESTS)'
-            rx = re.compile(regex, re.MULTILINE)
-            file_regex = r'\"([A-Za-z0-9/_.]+)\"'
-            file_rx = re.compile(file_regex, re.DOTALL)
-            start: int = 0
-            while start < len(mb):
-                m = rx.search(mb, start)
-                if m:
-                    (i, j) = m.span()
-                    if i >= start:
-                        title = mb[i:j]
-                        self.verr(f'  TITLE={title}')
-                        tj = mb.index(']', j)
-                        for file_m in file_rx.finditer(mb,j,tj+1):
-                            # self.verr(f'    FILE_M={file_m}={file_m.span()}')
-                            # (_, mj) = file_m.span()
-                            match: str = file_m.group(0) # type: ignore
-                            # fi = match.index('"') # type: ignore
-                            # fj = match.index('"', fi+1) # type: ignore
-                            filename: str = match[1:-1] # type: ignore
-                            # self.verr(f'    FILE_M={file_m}={file_m.span()}={filename}')
-                            if filename.endswith('.ini'):
-                                pathname = os.path.join(os.path.dirname(path), filename)
-                                self.verr(f'    {filename} = {pathname}')
-                                self.ini_files[pathname] = self.ini_files.get(pathname, False)
-                                self.check_for_includes(pathname)
-                            j = tj
-                    start = j + 1
-                else:
-                    break
-
-    def find_ini(self) -> bool:
+        self.verr(f'MOZ.BUILD={path}=')
+        for (title, filename) in entry['refs']:
+            pathname = os.path.join(os.path.dirname(path), filename)
+            self.verr(f'  {title}: {filename} = {pathname}')
+            self.ini_files[pathname] = self.ini_files.get(pathname, False)
+            self.check_for_includes(pathname)
+
+    def scan_dir(self, path: str) -> Tuple[List[str], List[str], List[str]]:
+        """
+        Returns a tuple of (ini files, moz.build files, subdirectories) in
+        the directory path (skipping subdirectories matching ignore_dirs)
+        """
+        ini_paths: List[str] = []
+        mb_paths: List[str] = []
+        subdirs: List[str] = []
+        try:
+            entries = list(os.scandir(path))
+        except OSError: # as os.walk, ignore unreadable directories
+            return (ini_paths, mb_paths, subdirs)
+        for entry in entries:
+            try:
+                is_dir: bool = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                if not entry.is_symlink() and not self.ignore_rx.fullmatch(entry.name):
+                    subdirs.append(entry.path)
+            elif entry.name.endswith('.ini'):
+                ini_paths.append(entry.path)
+            elif entry.name == 'moz.build':
+                mb_paths.append(entry.path)
+        return (ini_paths, mb_paths, subdirs)
+
+    def scan_tree(self) -> Tuple[List[str], List[str]]:
+        """
+        Returns a tuple of the sorted (ini files, moz.build files) in topsrcdir
+        (relative to topsrcdir) by scanning subdirectories concurrently
+        and pruning the ignore_dirs
+        """
+        ini_paths: List[str] = []
+        mb_paths: List[str] = []
+        with ThreadPoolExecutor() as executor:
+            pending: Set[Future[Tuple[List[str], List[str], List[str]]]] = {
+                executor.submit(self.scan_dir, self.topsrcdir)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    (inis, mbs, subdirs) = future.result()
+                    ini_paths.extend(inis)
+                    mb_paths.extend(mbs)
+                    for subdir in subdirs:
+                        pending.add(executor.submit(self.scan_dir, subdir))
+        n: int = len(self.topsrcdir)
+        return (sorted(['.' + p[n:] for p in ini_paths]), # make paths relative
+                sorted(['.' + p[n:] for p in mb_paths]))
+
+    def find_ini(self, graph_file: str | None = None, moz_build_file: str | None = None) -> bool:
         """
         Prints relative path of each matching *.ini file
+        (and writes the include graph as JSON to graph_file and
+        the moz.build of each manifest to moz_build_file)
         """
         self.ini_files = {}
-        for root, _dirs, files in os.walk(self.topsrcdir, topdown=True):
-            if root.find(os.sep + 'obj-') >= 0:
-                continue
-            for file in files:
-                if file.endswith('.ini'):
-                    fullpath: str = os.path.join(root, file)
-                    path = '.' + fullpath[len(self.topsrcdir):] # make path relative
-                    if not path.startswith('./obj-'): # ignore build directories
-                        if self.regex.fullmatch(file):
-                            self.ini_files[path] = self.ini_files.get(path, False)
-                        if not self.ignore_includes:
-                            self.check_for_includes(path)
-                elif file == 'moz.build':
-                    fullpath: str = os.path.join(root, file)
-                    path = '.' + fullpath[len(self.topsrcdir):] # make path relative
-                    self.check_moz_build(path)
+        self.find_paths = set()
+        self.include_graph = IncludeGraph()
+        self.init_build_dir()
+        self.load_find_index()
+        (ini_paths, mb_paths) = self.scan_tree()
+        self.prefetch_file_refs(mb_paths if self.ignore_includes else ini_paths + mb_paths)
+        for path in ini_paths:
+            if self.regex.fullmatch(os.path.basename(path)):
+                self.ini_files[path] = self.ini_files.get(path, False)
+            if not self.ignore_includes:
+                self.check_for_includes(path)
+        for path in mb_paths:
+            self.check_moz_build(path)
+        self.save_find_index(self.find_paths)
+        for cycle in self.include_graph.cycles:
+            self.err(f'include cycle: {" -> ".join(cycle)}')
+        try:
+            if graph_file:
+                with open(file=graph_file, mode='w') as f:
+                    f.write(self.include_graph.to_json() + '\n')
+            if moz_build_file:
+                with open(file=moz_build_file, mode='w') as f:
+                    for (manifest, moz_build, title, filename) in self.moz_build_index():
+                        f.write(f'{manifest} {moz_build}:{title} "{filename}"\n')
+        except OSError as e:
+            self.err(f'{e}')
+            return False
         for f in sorted(self.ini_files.keys()):
             if f.find('generated') < 0:
                 self.out(f)
@@ -1296,55 +2105,1498 @@ class MetaManifestParser:
 
     def initialize_parser(self) -> bool:
         """
-        Initializes the parser from the ir.ebnf file
+        Initializes the parsers from the ir.ebnf and ir-lalr.ebnf files
         """
         pdir: str = os.path.dirname(p=sys.argv[0])
-        ir_ebnf_path = os.path.join(pdir, 'ir.ebnf')
-        if not os.path.exists(ir_ebnf_path):
-            self.err(f'ir.ebnf not found: {ir_ebnf_path}')
-            return False
-        ir_ebnf: str | None = self.read_file_as_string(ir_ebnf_path)
-        if ir_ebnf == None:
-            self.err(f'cannot read ir.ebnf: {ir_ebnf_path}')
-            return False
-        self.ir_ebnf = ir_ebnf
+        for filename in ['ir.ebnf', 'ir-lalr.ebnf']:
+            path = os.path.join(pdir, filename)
+            if not os.path.exists(path):
+                self.err(f'{filename} not found: {path}')
+                return False
+            grammar: str | None = self.read_file_as_string(path)
+            if grammar == None:
+                self.err(f'cannot read {filename}: {path}')
+                return False
+            if filename == 'ir.ebnf':
+                self.ir_ebnf = grammar
+            else:
+                self.ir_lalr_ebnf = grammar
+        self.init_build_dir()
         return True
 
-    def read_ini(self, ini_file: str) -> bool:
+    def init_build_dir(self) -> None:
+        "Sets the default build directory (MMP/build)"
+        if not self.build_dir:
+            self.build_dir = os.path.join(os.path.dirname(p=sys.argv[0]), 'build')
+
+    def parser_grammar(self, engine: str) -> Tuple[str, str]:
+        "Returns tuple of (grammar filename, grammar) for the engine"
+        if engine == 'lalr':
+            return ('ir-lalr.ebnf', self.ir_lalr_ebnf)
+        return ('ir.ebnf', self.ir_ebnf)
+
+    def parser_cache_key(self, engine: str = 'earley') -> str:
         """
-        Reads the given *.ini file
+        Returns the cache key for the compiled parser: a hash of the grammar,
+        the lark version and the python version (for pickle compatibility)
         """
-        fullpath: str = os.path.join(self.topsrcdir, ini_file)
-        ini: str | None = self.read_binary_file_as_string(fullpath)
+        (_, grammar) = self.parser_grammar(engine)
+        h = hashlib.sha256(grammar.encode('utf-8'))
+        h.update(f'lark={lark.__version__}'.encode('utf-8'))
+        h.update(f'python={sys.version_info[0]}.{sys.version_info[1]}'.encode('utf-8'))
+        return h.hexdigest()
+
+    def load_cached_parser(self, cache_path: str) -> Lark | None:
+        """
+        Returns the compiled parser from the on-disk cache (or None)
+        """
+        if not os.path.exists(cache_path):
+            return None
+        try:
+            with open(file=cache_path, mode='rb') as f:
+                parser: Lark = ParserUnpickler(f).load()
+        except Exception as e: # a stale or corrupt cache is simply rebuilt
+            self.verr(f'cannot load cached parser {cache_path}: {e}')
+            return None
+        self.verr(f'loaded cached parser: {cache_path}')
+        return parser
+
+    def clean_parser_cache(self, cache_path: str) -> None:
+        """
+        Creates the build directory and removes parsers cached for
+        previous versions of the grammar (raises OSError)
+        """
+        prefix: str = os.path.basename(cache_path).rsplit('-', 1)[0] + '-'
+        os.makedirs(self.build_dir, exist_ok=True)
+        for filename in os.listdir(self.build_dir):
+            if filename.startswith(prefix) and filename.endswith('.pickle'):
+                os.remove(os.path.join(self.build_dir, filename))
+
+    def save_cached_parser(self, cache_path: str, parser: Lark) -> None:
+        """
+        Saves the compiled parser to the on-disk cache
+        """
+        try:
+            self.clean_parser_cache(cache_path)
+            tmp_path: str = f'{cache_path}.{os.getpid()}.tmp'
+            with open(file=tmp_path, mode='wb') as f:
+                ParserPickler(f, protocol=pickle.HIGHEST_PROTOCOL).dump(parser)
+            os.replace(tmp_path, cache_path) # atomic for concurrent writers
+        except OSError as e:
+            self.verr(f'cannot save cached parser {cache_path}: {e}')
+            return
+        self.verr(f'saved cached parser: {cache_path}')
+
+    def get_parser(self, engine: str = 'earley') -> Lark | None:
+        """
+        Returns the compiled parser for the engine ('earley' for ir.ebnf
+        or 'lalr' for ir-lalr.ebnf): from memory, from the on-disk cache
+        or built from the grammar (and then cached)
+        The LALR parser builds the IR while parsing (with an inline IRTransformer)
+        """
+        (filename, grammar) = self.parser_grammar(engine)
+        key: str = self.parser_cache_key(engine)
+        if f'{engine}-{key}' in parsers:
+            return parsers[f'{engine}-{key}']
+        cache_path: str = os.path.join(self.build_dir, f'{filename.replace(".", "-")}-{key}.pickle')
+        parser: Lark | None = None
+        if self.cache and engine == 'earley':
+            parser = self.load_cached_parser(cache_path)
+        if parser is None:
+            try:
+                if engine == 'lalr': # lark caches LALR parsers itself (keeping the transformer)
+                    cache: str | bool = False
+                    if self.cache:
+                        try:
+                            if not os.path.exists(cache_path):
+                                self.clean_parser_cache(cache_path)
+                            cache = cache_path
+                        except OSError as e:
+                            self.verr(f'cannot use cached parser {cache_path}: {e}')
+                    parser = Lark(grammar, parser='lalr', lexer='contextual', start='manifest',
+                                  transformer=IRTransformer(True, self), cache=cache)
+                else:
+                    parser = Lark(grammar, parser='earley', start='manifest')
+            except GrammarError as e:
+                self.err(f'GrammarError with {filename}: {e}')
+                return None
+            except ConfigurationError as e:
+                self.err(f'ConfigurationError with {filename}: {e}')
+                return None
+            if self.cache and engine == 'earley':
+                self.save_cached_parser(cache_path, parser)
+        parsers[f'{engine}-{key}'] = parser
+        return parser
+
+    def parse_ini(self, ini: str) -> Tree[Token] | None:
+        """
+        Returns the IR for the ini text (or None on error)
+        Parses with the LALR grammar, falling back to the Earley grammar
+        if the LALR parse fails (or as forced by --engine).
+        With LALR the IR is built in a single pass, with Earley the
+        parse tree is transformed afterwards.
+        Sets parsed_engine to the one which parsed the text
+        The parse is aborted (with an error) if it is over the
+        --max-parse-seconds or --max-parse-mb budget (the parsers are
+        built, or loaded from the cache, before the budget starts)
+        """
+        engines: List[str] = ['lalr', 'earley']
+        if self.engine != 'auto':
+            engines = [self.engine]
+        parsers: List[Tuple[str, Lark]] = []
+        for engine in engines:
+            with self.profile_phase('grammar'):
+                parser: Lark | None = self.get_parser(engine)
+            if parser is None:
+                return None
+            parsers.append((engine, parser))
+        try:
+            with self.parse_budget():
+                return self._parse_ini(ini, parsers)
+        except ParseBudgetExceeded as e:
+            self.err(f'parsing aborted: {e} (see --ambiguity)')
+            return None
+
+    def _parse_ini(self, ini: str, parsers: List[Tuple[str, Lark]]) -> Tree[Token] | None:
+        "Returns the IR for the ini text with the first of the (engine, parser) parsers which succeeds (see parse_ini)"
+        for (engine, parser) in parsers:
+            self.read_toml = True # assume TOML
+            try:
+                if engine == 'lalr':
+                    parser.options.transformer.mmp = self # parser may be shared
+                    with self.profile_phase('parse'):
+                        manifest: Tree[Token] = parser.parse(ini)
+                else:
+                    with self.profile_phase('parse'):
+                        manifest: Tree[Token] = parser.parse(ini)
+                    self.verr("==TRANSFORM==")
+                    with self.profile_phase('transform'):
+                        manifest = IRTransformer(True, self).transform(manifest) # type: ignore
+            except UnexpectedInput as e:
+                if engine != parsers[-1][0]:
+                    self.verr(f'{engine} parsing failed (will try {parsers[-1][0]}): {e}')
+                    continue
+                self.err(f'parsing error: {e}')
+                return None
+            self.parsed_engine = engine
+            return manifest
+        return None
+
+    @contextmanager
+    def parse_budget(self) -> Iterator[None]:
+        """
+        Raises ParseBudgetExceeded in the enclosed parse (from a SIGALRM
+        interval timer) once it takes more than max_parse_seconds or
+        allocates more than max_parse_mb (as traced by tracemalloc).
+        There is no budget without SIGALRM or outside of the main thread
+        """
+        if (self.max_parse_seconds <= 0 and self.max_parse_mb <= 0) or not hasattr(signal, 'setitimer') \
+           or threading.current_thread() is not threading.main_thread():
+            yield
+            return
+        start_tracing: bool = self.max_parse_mb > 0 and not tracemalloc.is_tracing()
+        if start_tracing:
+            tracemalloc.start()
+        start_memory: int = tracemalloc.get_traced_memory()[0] if self.max_parse_mb > 0 else 0
+        start: float = time.perf_counter()
+
+        def check(signum: int, frame: Any) -> None:
+            seconds: float = time.perf_counter() - start
+            if self.max_parse_seconds > 0 and seconds > self.max_parse_seconds:
+                raise ParseBudgetExceeded(f'over the budget of {self.max_parse_seconds} seconds')
+            if self.max_parse_mb > 0:
+                mb: float = (tracemalloc.get_traced_memory()[0] - start_memory) / (1024 * 1024)
+                if mb > self.max_parse_mb:
+                    raise ParseBudgetExceeded(f'over the budget of {self.max_parse_mb} MB ({mb:.0f} MB after {seconds:.1f} seconds)')
+
+        previous: Any = signal.signal(signal.SIGALRM, check)
+        signal.setitimer(signal.ITIMER_REAL, 0.05, 0.05)
+        try:
+            yield
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+            if start_tracing:
+                tracemalloc.stop()
+
+    def ambiguity_report(self, ini_file: str) -> bool:
+        """
+        Parses ini_file with ir.ebnf (within the parse budget), keeping the
+        shared packed parse forest, and writes a JSON report to outfile:
+        the number of derivations (parse trees) of the file and, for each
+        line where an ambiguous derivation starts, the number of ambiguous
+        nodes, the alternatives Lark considered for them and their rules
+        """
+        ini: str | None = self.read_binary_file_as_string(os.path.join(self.topsrcdir, ini_file))
         if ini == None:
             return False
+        key: str = f'forest-{self.parser_cache_key("earley")}'
+        if key not in parsers:
+            try:
+                parsers[key] = Lark(self.ir_ebnf, parser='earley', start='manifest', ambiguity='forest')
+            except (GrammarError, ConfigurationError) as e:
+                self.err(f'{type(e).__name__} with ir.ebnf: {e}')
+                return False
+        start: float = time.perf_counter()
         try:
-            parser = Lark(self.ir_ebnf, parser='earley', start='manifest')
-        except GrammarError as e:
-            self.err(f'GrammarError with ir.ebnf: {e}')
+            with self.parse_budget():
+                root: SymbolNode = parsers[key].parse(ini)
+                (derivations, ambiguous) = self.forest_ambiguity(root)
+        except UnexpectedInput as e:
+            self.err(f'parsing error: {e}')
             return False
-        except ConfigurationError as e:
-            self.err(f'ConfigurationError with ir.ebnf: {e}')
+        except ParseBudgetExceeded as e:
+            self.err(f'parsing aborted: {e}')
             return False
+        line_starts: List[int] = [0] + [m.end() for m in re.finditer('\n', ini)]
+        lines: Dict[int, Dict[str, Any]] = {}
+        for (name, node_start, node_end, alternatives) in ambiguous:
+            while node_start < node_end and ini[node_start] in ' \t\r\n': # the line of the first token
+                node_start += 1
+            n: int = bisect.bisect_right(line_starts, node_start)
+            if n not in lines:
+                lines[n] = {'line': n, 'text': ini[line_starts[n - 1]:].split('\n', 1)[0].rstrip(),
+                            'nodes': 0, 'alternatives': 0, 'rules': set()}
+            lines[n]['nodes'] += 1
+            lines[n]['alternatives'] += alternatives
+            lines[n]['rules'].add(name)
+        for line in lines.values():
+            line['rules'] = sorted(line['rules'])
+        self.out(json.dumps({'file': ini_file,
+                             'seconds': round(time.perf_counter() - start, 3),
+                             'derivations': derivations,
+                             'ambiguous_nodes': len(ambiguous),
+                             'alternatives': sum([a for (_, _, _, a) in ambiguous]),
+                             'lines': [lines[n] for n in sorted(lines)]}, indent=2))
+        return True
+
+    def forest_ambiguity(self, root: SymbolNode) -> Tuple[int, List[Tuple[str, int, int, int]]]:
+        """
+        Returns a tuple of the number of derivations of the parse forest
+        at root and a list of (rule, start, end, alternatives) for each
+        ambiguous node (with more than one packed node) in it
+        """
+        counts: Dict[int, int] = {}
+        ambiguous: List[Tuple[str, int, int, int]] = []
+        stack: List[Tuple[Any, bool]] = [(root, False)]
+        while stack: # post order (without recursion)
+            (node, visited) = stack.pop()
+            if id(node) in counts:
+                continue
+            if isinstance(node, SymbolNode):
+                if not visited:
+                    stack.append((node, True))
+                    stack.extend([(child, False) for child in node.children])
+                    continue
+                counts[id(node)] = sum([counts[id(child)] for child in node.children])
+                if node.is_ambiguous:
+                    name: str = node.s.name if hasattr(node.s, 'name') else str(node.s)
+                    ambiguous.append((str(name), node.start, node.end, len(node.children)))
+            elif isinstance(node, PackedNode):
+                children: List[Any] = [c for c in (node.left, node.right) if c is not None]
+                if not visited:
+                    stack.append((node, True))
+                    stack.extend([(child, False) for child in children])
+                    continue
+                count: int = 1
+                for child in children:
+                    count *= counts[id(child)]
+                counts[id(node)] = count
+            else: # token
+                counts[id(node)] = 1
+        return (counts[id(root)], ambiguous)
+
+    def conversion_cache_key(self, ini: str, write_toml: bool | None = None) -> str:
+        """
+        Returns the conversion cache key for the ini text: a hash of the text,
+        the grammars, this program and the options which change the output
+        (written as TOML or, if not write_toml, as INI)
+        """
+        if write_toml is None:
+            write_toml = self.write_toml
+        h = hashlib.sha256(ini.encode('utf-8'))
+        h.update(self.parser_cache_key('earley').encode('utf-8'))
+        h.update(self.parser_cache_key('lalr').encode('utf-8'))
+        h.update(program_digest().encode('utf-8'))
+        h.update(f'fix_implicit={self.fix_implicit},write_toml={write_toml},'
+                 f'debug_expr={self.debug_expr},keep_dotted={self.keep_dotted}'.encode('utf-8'))
+        return h.hexdigest()
+
+    def load_cached_conversion(self, key: str) -> Tuple[Dict[str, Any], TextIO] | None:
+        """
+        Returns a tuple of the cached conversion {'engine', 'read_toml'} and
+        the cache file, open at the output (or None)
+        """
+        cache_path: str = os.path.join(self.build_dir, 'convert', f'{key}.out')
         try:
-            manifest = parser.parse(ini)
-        except UnexpectedToken as e:
-            self.err(f'parsing error: {e}')
-        except UnexpectedCharacters as e:
-            self.err(f'parsing error: {e}')
+            f: TextIO = open(file=cache_path, mode='r', encoding='utf-8', newline='') # preserve CRLF
+        except OSError:
+            return None
+        try:
+            conversion: Dict[str, Any] = json.loads(f.readline())
+            os.utime(cache_path) # most recently used
+        except (OSError, ValueError):
+            f.close()
+            return None
+        return (conversion, f)
+
+    def save_cached_conversion(self, key: str, conversion: Dict[str, Any], manifest: IRTree,
+                               files: List[TextIO], emitter: Emitter) -> None:
+        """
+        Writes the output of manifest (by emitter) to files and saves it (with
+        the conversion) in the conversion cache, evicting the least recently
+        used conversions if the cache is larger than cache_size MB
+        """
+        cache_dir: str = os.path.join(self.build_dir, 'convert')
+        cache_path: str = os.path.join(cache_dir, f'{key}.out')
+        tmp_path: str = f'{cache_path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            f: TextIO = open(file=tmp_path, mode='w', encoding='utf-8', newline='')
+        except OSError as e:
+            self.verr(f'cannot save cached conversion {cache_path}: {e}')
+            manifest.write_pretty(files, emitter)
+            return
+        cache: CacheWriter = CacheWriter(f)
+        saved: bool = False
+        try:
+            cache.write(json.dumps(conversion) + '\n')
+            manifest.write_pretty(files + [cache], emitter) # type: ignore
+            cache.close()
+            if cache.error is None:
+                os.replace(tmp_path, cache_path) # atomic for concurrent writers
+                saved = True
+                if self.cache_bytes < 0:
+                    self.cache_bytes = sum([e.stat().st_size for e in os.scandir(cache_dir)])
+                else:
+                    self.cache_bytes += os.path.getsize(cache_path)
+        except OSError as e:
+            cache.error = cache.error or e
+        finally:
+            cache.close()
+            if not saved:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+        if cache.error is not None:
+            self.verr(f'cannot save cached conversion {cache_path}: {cache.error}')
+            return
+        if self.cache_bytes > self.cache_size * 1024 * 1024:
+            self.evict_cached_conversions(cache_dir)
+
+    def evict_cached_conversions(self, cache_dir: str) -> None:
+        """
+        Removes the least recently used conversions until the cache is
+        down to 3/4 of cache_size MB
+        """
+        entries: List[Tuple[float, int, str]] = []
+        for entry in os.scandir(cache_dir):
+            try:
+                st = entry.stat()
+            except OSError: # removed by another process
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+        entries.sort()
+        self.cache_bytes = sum([size for (_, size, _) in entries])
+        limit: int = self.cache_size * 1024 * 1024 * 3 // 4
+        for (_, size, path) in entries:
+            if self.cache_bytes <= limit:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.cache_bytes -= size
+        self.verr(f'conversion cache evicted to {self.cache_bytes} bytes')
+
+    @contextmanager
+    def profile_phase(self, phase: str) -> Iterator[None]:
+        """
+        Adds the wall clock and CPU time and the tracemalloc peak (above
+        the memory in use at the start) of the enclosed phase to the
+        profile of the file being read (if profiling)
+        """
+        if self.profile is None:
+            yield
+            return
+        start_memory: int = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        start_wall: float = time.perf_counter()
+        start_cpu: float = time.process_time()
+        try:
+            yield
+        finally:
+            p: Dict[str, float] = self.profile['phases'].setdefault(phase, {'wall': 0.0, 'cpu': 0.0, 'peak_mb': 0.0})
+            p['wall'] += time.perf_counter() - start_wall
+            p['cpu'] += time.process_time() - start_cpu
+            p['peak_mb'] = max(p['peak_mb'], (tracemalloc.get_traced_memory()[1] - start_memory) / (1024 * 1024))
+
+    def write_profile(self) -> None:
+        "Appends the profile of the file just read as one JSON line to profile_file"
+        if self.profile is None or not self.profile_file:
+            return
+        for p in self.profile['phases'].values():
+            for k in p:
+                p[k] = round(p[k], 6)
+        try:
+            with open(file=self.profile_file, mode='a') as f: # one write per line (shared by --jobs workers)
+                f.write(json.dumps(self.profile) + '\n')
+        except OSError as e:
+            self.err(f'cannot write profile {self.profile_file}: {e}')
+
+    def read_ini(self, ini_file: str, ini_outfile: TextIO | None = None) -> bool:
+        """
+        Reads the given *.ini file
+        The output is streamed to outfile as it is generated (or from the
+        conversion cache if the file and the options have not changed
+        since it was last converted).
+        If ini_outfile is given the INI is also written to it (from the
+        same parse)
+        With --profile the time and memory of each phase (read, cache,
+        grammar, parse, transform and write) is appended to profile_file
+        (and with --cprofile the cProfile stats are written to cprofile_dir)
+        """
+        if not self.profile_file and not self.cprofile_dir:
+            return self._read_ini(ini_file, ini_outfile)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.profile = {'file': ini_file, 'ok': False, 'engine': None, 'cached': False, 'phases': {}}
+        profiler: cProfile.Profile | None = cProfile.Profile() if self.cprofile_dir else None
+        start_wall: float = time.perf_counter()
+        start_cpu: float = time.process_time()
+        ok: bool = False
+        try:
+            if profiler is not None:
+                profiler.enable()
+            ok = self._read_ini(ini_file, ini_outfile)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            self.profile['ok'] = ok
+            self.profile['engine'] = self.parsed_engine or None
+            self.profile['wall'] = round(time.perf_counter() - start_wall, 6)
+            self.profile['cpu'] = round(time.process_time() - start_cpu, 6)
+            self.profile['peak_mb'] = round(max([p['peak_mb'] for p in self.profile['phases'].values()] or [0.0]), 6)
+            if profiler is not None:
+                path: str = os.path.join(self.cprofile_dir, os.path.normpath(ini_file).replace(os.sep, '_') + '.prof')
+                try:
+                    os.makedirs(self.cprofile_dir, exist_ok=True)
+                    profiler.dump_stats(path)
+                    self.profile['cprofile'] = path
+                except OSError as e:
+                    self.err(f'cannot write cProfile {path}: {e}')
+            self.write_profile()
+            self.profile = None
+        return ok
+
+    def _read_ini(self, ini_file: str, ini_outfile: TextIO | None = None) -> bool:
+        "Reads the given *.ini file (see read_ini)"
+        fullpath: str = os.path.join(self.topsrcdir, ini_file)
+        self.parsed_engine = ''
+        with self.profile_phase('read'):
+            ini: str | None = self.read_binary_file_as_string(fullpath)
+        if ini == None:
+            return False
+        cached: List[Tuple[Dict[str, Any], TextIO]] = []
+        with self.profile_phase('cache'):
+            outputs: List[Tuple[str, Emitter, TextIO]] = [
+                (self.conversion_cache_key(ini), get_emitter(self), self.outfile)]
+            if ini_outfile is not None:
+                outputs.append((self.conversion_cache_key(ini, False), get_emitter(self, False), ini_outfile))
+            if self.cache:
+                for (key, _, _) in outputs:
+                    c: Tuple[Dict[str, Any], TextIO] | None = self.load_cached_conversion(key)
+                    if c is None:
+                        break
+                    cached.append(c)
+        if len(cached) == len(outputs):
+            (conversion, _) = cached[0]
+            self.parsed_engine = conversion['engine']
+            self.read_toml = conversion['read_toml']
+            self.verr(f"== CACHED {ini_file} parsed with {self.parsed_engine} ==")
+            self.verr(f"== File is legal TOML? {self.read_toml} ==")
+            if not self.read_toml and self.strict_toml:
+                self.err('error: input is not strict TOML')
+                for (_, f) in cached:
+                    f.close()
+                return False
+            self.verr(f"== PRETTY as TOML? {self.write_toml}==")
+            if self.profile is not None:
+                self.profile['cached'] = True
+            with self.profile_phase('write'):
+                for ((_, f), (_, _, outfile)) in zip(cached, outputs):
+                    with f:
+                        shutil.copyfileobj(f, outfile)
+            return True
+        for (_, f) in cached:
+            f.close()
+        manifest: Tree[Token] | None = self.parse_ini(ini)
+        if manifest is None:
             return False
-        self.verr("==TRANSFORM==")
-        self.read_toml = True # assume TOML
-        manifest: Tree[Token] = IRTransformer(True, self).transform(manifest) # type: ignore
+        self.verr(f"== PARSED {ini_file} with {self.parsed_engine} ==")
         self.verr(f"== File is legal TOML? {self.read_toml} ==")
         self.verr("==PLAIN==")
         self.verr(manifest)
+        conversion: Dict[str, Any] = {'engine': self.parsed_engine, 'read_toml': self.read_toml}
         if not self.read_toml and self.strict_toml:
             self.err('error: input is not strict TOML')
+            if self.cache:
+                for (key, emitter, _) in outputs:
+                    self.save_cached_conversion(key, conversion, manifest, [], emitter) # type: ignore
             return False
         self.verr(f"== PRETTY as TOML? {self.write_toml}==")
-        self.out(manifest.pretty()) # type: ignore
+        with self.profile_phase('write'):
+            for (key, emitter, outfile) in outputs:
+                if self.cache:
+                    self.save_cached_conversion(key, conversion, manifest, [outfile], emitter) # type: ignore
+                else:
+                    manifest.write_pretty([outfile], emitter) # type: ignore
+        return True
+
+    def batch_output_path(self, ini_file: str, output_dir: str | None, write_toml: bool | None = None) -> str | None:
+        """
+        Returns the output path for ini_file (relative to topsrcdir):
+        with the .toml (or, if not write_toml, .ini) extension next to the
+        input file, or at the same relative path in output_dir.
+        Returns None if the output would overwrite the input
+        """
+        if write_toml is None:
+            write_toml = self.write_toml
+        fullpath: str = os.path.join(self.topsrcdir, ini_file)
+        ext: str = '.toml' if write_toml else '.ini'
+        if output_dir:
+            path: str = os.path.relpath(fullpath, self.topsrcdir)
+            if path.startswith(os.pardir):
+                path = os.path.basename(path) # outside of topsrcdir
+            path = os.path.join(output_dir, os.path.splitext(path)[0] + ext)
+        else:
+            path: str = os.path.splitext(fullpath)[0] + ext
+        if os.path.abspath(path) == os.path.abspath(fullpath):
+            return None
+        return path
+
+    def batch_convert(self, ini_file: str, output_dir: str | None, ini_output_dir: str | None = None) -> Tuple[bool, str]:
+        """
+        Reads ini_file and writes the output file (see batch_output_path),
+        and also the INI in ini_output_dir (if given).
+        Returns a tuple of (passed, status line).
+        Any error is reported in the status line (instead of being raised)
+        """
+        path: str | None = self.batch_output_path(ini_file, output_dir)
+        ini_path: str | None = None
+        if ini_output_dir:
+            ini_path = self.batch_output_path(ini_file, ini_output_dir, False)
+        if path is None or (ini_output_dir and ini_path is None):
+            return (False, f'FAILED {ini_file} (output would overwrite input, use --output-dir)')
+        paths: List[str] = [path] if ini_path is None else [path, ini_path]
+        outfile: TextIO = self.outfile
+        ok: bool = False
+        try:
+            for p in paths:
+                os.makedirs(os.path.dirname(p) or '.', exist_ok=True)
+            self.outfile = open(file=path, mode='w')
+            ini_outfile: TextIO | None = None
+            try:
+                if ini_path is not None:
+                    ini_outfile = open(file=ini_path, mode='w')
+                ok = self.read_ini(ini_file, ini_outfile)
+            finally:
+                self.outfile.close()
+                self.outfile = outfile
+                if ini_outfile is not None:
+                    ini_outfile.close()
+            if not ok:
+                for p in paths:
+                    if os.path.exists(p):
+                        os.remove(p)
+        except Exception as e: # one bad file must not stop the batch
+            return (False, f'FAILED {ini_file} ({type(e).__name__}: {e})')
+        if not ok:
+            return (False, f'FAILED {ini_file}')
+        return (True, f'PASSED {ini_file} ({self.parsed_engine}, legal TOML: {self.read_toml}) {" ".join(paths)}')
+
+    def batch_options(self) -> Dict[str, Any]:
+        "Returns the options needed to create a MetaManifestParser for a batch worker"
+        return {'build_dir': self.build_dir, 'cache': self.cache, 'cache_size': self.cache_size,
+                'debug_expr': self.debug_expr, 'engine': self.engine, 'fix_implicit': self.fix_implicit,
+                'ir_ebnf': self.ir_ebnf, 'ir_lalr_ebnf': self.ir_lalr_ebnf, 'keep_dotted': self.keep_dotted,
+                'cprofile_dir': self.cprofile_dir, 'profile_file': self.profile_file,
+                'max_parse_mb': self.max_parse_mb, 'max_parse_seconds': self.max_parse_seconds,
+                'strict_toml': self.strict_toml, 'topsrcdir': self.topsrcdir,
+                'verbose': self.verbose, 'write_toml': self.write_toml}
+
+    def read_file_list(self, list_file: str) -> List[str] | None:
+        """
+        Returns the sorted (unique) files listed in list_file, one per line
+        (ignoring blank lines and comments), or None on error
+        """
+        listing: str | None = self.read_file_as_string(list_file)
+        if listing == None:
+            return None
+        return sorted(set([line.strip() for line in listing.splitlines()
+                           if line.strip() and not line.strip().startswith('#')]))
+
+    def read_batch(self, list_file: str, output_dir: str | None, ini_output_dir: str | None = None) -> bool:
+        """
+        Reads each *.ini file listed in list_file (one per line, relative
+        to topsrcdir) with a single parser (per worker process with --jobs),
+        writing each output file (see batch_output_path), and the INI
+        in ini_output_dir (if given), and printing the status of each
+        file, in sorted order, followed by a summary.
+        Returns True if all files were converted.
+        """
+        ini_files: List[str] | None = self.read_file_list(list_file)
+        if ini_files is None:
+            return False
+        # build (and cache) the parsers once, before any worker is started
+        for engine in (['lalr', 'earley'] if self.engine == 'auto' else [self.engine]):
+            if self.get_parser(engine) is None:
+                return False
+        passed: int = 0
+        if self.jobs == 1 or len(ini_files) < 2:
+            for ini_file in ini_files:
+                (ok, status) = self.batch_convert(ini_file, output_dir, ini_output_dir)
+                passed += 1 if ok else 0
+                self.out(status)
+        else:
+            with ProcessPoolExecutor(max_workers=self.jobs, initializer=init_batch_worker,
+                                     initargs=(self.batch_options(),)) as executor:
+                futures: List[Future[Tuple[bool, str]]] = [
+                    executor.submit(batch_worker, ini_file, output_dir, ini_output_dir) for ini_file in ini_files]
+                for ini_file, future in zip(ini_files, futures):
+                    try:
+                        (ok, status) = future.result()
+                    except BrokenProcessPool as e: # a worker died
+                        (ok, status) = (False, f'FAILED {ini_file} (BrokenProcessPool: {e})')
+                    passed += 1 if ok else 0
+                    self.out(status)
+        self.out(f'== BATCH {passed} of {len(ini_files)} passed, {len(ini_files) - passed} failed ==')
+        return passed == len(ini_files)
+
+    def compare_tests(self, ini_tests: List[Dict[str, Any]], toml_tests: List[Dict[str, Any]]) -> List[str]:
+        """
+        Returns the differences between the tests read by ManifestParser
+        from the INI and from the TOML (as in compare-tests.py: the manifest
+        may only differ by extension and the other values by whitespace
+        and explicit || operators)
+        """
+        diffs: List[str] = []
+        if len(ini_tests) != len(toml_tests):
+            diffs.append(f'{len(ini_tests)} tests in INI, {len(toml_tests)} in TOML')
+        for (i, (ini_test, toml_test)) in enumerate(zip(ini_tests, toml_tests)):
+            for k in sorted(set(ini_test.keys()) | set(toml_test.keys())):
+                if k not in ini_test or k not in toml_test:
+                    diffs.append(f'test {i} {k}: only in {"INI" if k in ini_test else "TOML"}')
+                    continue
+                old_value: Any = ini_test[k]
+                new_value: Any = toml_test[k]
+                if old_value == new_value:
+                    continue
+                if type(old_value) != type(new_value) or not isinstance(old_value, str):
+                    diffs.append(f'test {i} {k}: {old_value!r} != {new_value!r}')
+                elif k.find('manifest') >= 0:
+                    if os.path.splitext(old_value)[0] != os.path.splitext(new_value)[0]:
+                        diffs.append(f'test {i} {k}: MANIFEST MISMATCH {old_value!r} != {new_value!r}')
+                else:
+                    old_value = re.sub(r'\s+', ' ', re.sub(r' \|\|', ' ', old_value.strip()))
+                    new_value = re.sub(r'\s+', ' ', re.sub(r' \|\|', ' ', new_value.strip()))
+                    if old_value != new_value:
+                        diffs.append(f'test {i} {k}: {old_value!r} != {new_value!r}')
+        return diffs
+
+    def compare_manifest_tests(self, ini_file: str, toml: str) -> List[str]:
+        """
+        Returns the differences between the tests ManifestParser reads from
+        ini_file and from the toml text (which is written next to ini_file
+        while it is read, any existing TOML file is restored)
+        """
+        fullpath: str = os.path.join(self.topsrcdir, ini_file)
+        toml_path: str = os.path.splitext(fullpath)[0] + '.toml'
+        save_path: str = toml_path + '.save'
+        if os.path.exists(toml_path):
+            os.replace(toml_path, save_path)
+        try:
+            with open(file=toml_path, mode='w', encoding='utf-8', newline='') as f:
+                f.write(toml)
+            ini_tests: List[Dict[str, Any]] = ManifestParser(manifests=[fullpath], strict=True, use_toml=False).tests
+            toml_tests: List[Dict[str, Any]] = ManifestParser(manifests=[toml_path], strict=True, use_toml=True).tests
+        finally:
+            if os.path.exists(toml_path):
+                os.remove(toml_path)
+            if os.path.exists(save_path):
+                os.replace(save_path, toml_path)
+        return self.compare_tests(ini_tests, toml_tests)
+
+    def verify_file(self, ini_file: str) -> Dict[str, Any]:
+        """
+        Verifies ini_file with a single parse, returning the report for it:
+        * round_trip: the IR written as INI is the same as the input (byte for byte)
+        * toml_legal: the IR written as TOML can be read by tomllib (None if not available)
+        * tests_match: ManifestParser reads the same tests from the TOML (None if not available)
+        """
+        start: float = time.perf_counter()
+        report: Dict[str, Any] = {'file': ini_file, 'status': 'failed', 'engine': None, 'read_toml': None,
+                                  'round_trip': False, 'toml_legal': None, 'tests_match': None}
+        try:
+            ini: str | None = self.read_binary_file_as_string(os.path.join(self.topsrcdir, ini_file))
+            if ini is None:
+                report['error'] = 'cannot read file'
+                return report
+            manifest: IRTree | None = self.parse_ini(ini) # type: ignore
+            if manifest is None:
+                report['error'] = 'parsing error'
+                return report
+            report['engine'] = self.parsed_engine
+            report['read_toml'] = self.read_toml
+            output: str = manifest.pretty(get_emitter(self, False))
+            report['round_trip'] = output == ini
+            if output != ini:
+                lines: List[str] = ini.splitlines(keepends=True)
+                out_lines: List[str] = output.splitlines(keepends=True)
+                n: int = 0
+                while n < len(lines) and n < len(out_lines) and lines[n] == out_lines[n]:
+                    n += 1
+                report['round_trip_line'] = n + 1 # first line which differs
+            toml: str = manifest.pretty(get_emitter(self, True)) + '\n'
+            if tomllib is not None:
+                try:
+                    tomllib.loads(toml)
+                    report['toml_legal'] = True
+                except tomllib.TOMLDecodeError as e:
+                    report['toml_legal'] = False
+                    report['toml_error'] = str(e)
+            if ManifestParser is not None and ini_file.endswith('.ini'):
+                try:
+                    diffs: List[str] = self.compare_manifest_tests(ini_file, toml)
+                    report['tests_match'] = len(diffs) == 0
+                    if diffs:
+                        report['tests_diffs'] = diffs
+                except Exception as e: # report any ManifestParser error
+                    report['tests_match'] = False
+                    report['tests_error'] = f'{type(e).__name__}: {e}'
+            if report['round_trip'] and report['toml_legal'] is not False and report['tests_match'] is not False:
+                report['status'] = 'passed'
+        except Exception as e: # one bad file must not stop the verification
+            report['error'] = f'{type(e).__name__}: {e}'
+        finally:
+            report['seconds'] = round(time.perf_counter() - start, 3)
+        return report
+
+    def verify(self, list_file: str, skipped_file: str | None) -> bool:
+        """
+        Verifies each *.ini file listed in list_file (except those listed in
+        skipped_file) in this process (or --jobs worker processes), writing
+        the report for each file (see verify_file), in sorted order,
+        as one JSON object per line to outfile, followed by a summary.
+        Returns True if all files passed.
+        """
+        ini_files: List[str] | None = self.read_file_list(list_file)
+        if ini_files is None:
+            return False
+        skipped: Set[str] = set()
+        if skipped_file:
+            skipped_files: List[str] | None = self.read_file_list(skipped_file)
+            if skipped_files is None:
+                return False
+            skipped = set([os.path.normpath(f) for f in skipped_files])
+        for engine in (['lalr', 'earley'] if self.engine == 'auto' else [self.engine]):
+            if self.get_parser(engine) is None:
+                return False
+        todo: List[str] = [f for f in ini_files if os.path.normpath(f) not in skipped]
+        counts: Dict[str, int] = {'passed': 0, 'failed': 0, 'skipped': len(ini_files) - len(todo)}
+        start: float = time.perf_counter()
+        reports: Any = None
+        executor: ProcessPoolExecutor | None = None
+        if self.jobs == 1 or len(todo) < 2:
+            reports = map(self.verify_file, todo)
+        else:
+            executor = ProcessPoolExecutor(max_workers=self.jobs, initializer=init_batch_worker,
+                                           initargs=(self.batch_options(),))
+            reports = executor.map(verify_worker, todo, chunksize=4)
+        try:
+            for report in reports:
+                counts[report['status']] += 1
+                self.verr(f'{report["status"].upper()} {report["file"]}')
+                self.out(json.dumps(report))
+        except BrokenProcessPool as e: # a worker died
+            self.err(f'verify failed: {e}')
+            return False
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        self.out(json.dumps({'summary': counts, 'seconds': round(time.perf_counter() - start, 3)}))
+        return counts['failed'] == 0
+
+    def platform_values(self, platform: str) -> Dict[str, Any] | None:
+        """
+        Returns the platform values for --platform: read from a JSON file
+        (as mozinfo.json) or given as comma separated name=value pairs
+        (where true, false and integers are converted), or None on error
+        """
+        values: Dict[str, Any] = {}
+        if platform.endswith('.json'):
+            text: str | None = self.read_file_as_string(platform)
+            if text == None:
+                return None
+            try:
+                values = json.loads(text) # type: ignore
+            except json.JSONDecodeError as e:
+                self.err(f'platform invalid: {platform}: {e}')
+                return None
+            if not isinstance(values, dict):
+                self.err(f'platform invalid (not a JSON object): {platform}')
+                return None
+            return values
+        for pair in platform.split(','):
+            if not pair.strip():
+                continue
+            (name, sep, value) = pair.partition('=')
+            if not sep or not name.strip():
+                self.err(f'platform invalid (not name=value): "{pair}"')
+                return None
+            value = value.strip()
+            if value in ('true', 'false'):
+                values[name.strip()] = value == 'true'
+            elif re.fullmatch(r'-?[0-9]+', value):
+                values[name.strip()] = int(value)
+            else:
+                values[name.strip()] = value
+        return values
+
+    def manifest_items(self, manifest: Tree[Any]) -> Iterator[Tuple[str, str | None, Any]]:
+        """
+        Yields (section, None, None) for each section (table) of the manifest IR
+        (starting with DEFAULT) and (section, key, val) for each key in it
+        (where val is None for a key without a value)
+        """
+        emitter: Emitter = get_emitter(self, False)
+        section: str = 'DEFAULT'
+        yield (section, None, None)
+        for expression in manifest.children:
+            if not isinstance(expression, ir_trees) or len(expression.children) == 0: # type: ignore
+                continue
+            tree: Any = expression.children[0] # type: ignore
+            if not isinstance(tree, ir_trees):
+                continue
+            if tree.data in ('std_table', 'mp_table'):
+                section = emitter.table_key_string(tree.table_key)
+                yield (section, None, None)
+            elif tree.data == 'keyval' and isinstance(tree.children[0], ir_trees):
+                yield (section, emitter.table_key_string(tree.children[0]), tree.children[2])
+            elif tree.data == 'keynoval':
+                yield (section, str(tree.children[0]), None)
+
+    def manifest_sections(self, manifest: Tree[Any]) -> List[str]:
+        "Returns the names of the sections (tables) in the manifest IR"
+        return [section for (section, key, _) in self.manifest_items(manifest) if key is None and section != 'DEFAULT']
+
+    def val_text(self, val: Any) -> str:
+        "Returns the val of a key as written in the INI"
+        out: List[str] = []
+        if val is not None:
+            get_emitter(self, False).emit(val, 0, out)
+        return ''.join(out).strip()
+
+    def condition(self, val: Any) -> Tuple[str, Any] | None:
+        """
+        Returns the (text, node) of the val of a *-if key, where node is the
+        mp_expr (or boolean) and text is as written in the INI (node is None
+        for a TOML string, or array of strings, which is text with one line
+        per string), or None if val is not a condition
+        """
+        if not isinstance(val, ir_trees) or len(val.children) != 1: # type: ignore
+            return None
+        node: Any = val.children[0]
+        if isinstance(node, IRTree) and node.data == 'mp_expr' or isinstance(node, IRToken) and node.type == 'boolean':
+            return (self.val_text(node), node)
+        return ('\n'.join(self.val_strings(node)), None) # TOML
+
+    def val_strings(self, val: Any) -> List[str]:
+        "Returns the strings in the val of a key (the TOML string, or array of strings)"
+        strings: List[str] = []
+        pending: List[Any] = [val]
+        while pending:
+            n: Any = pending.pop()
+            if isinstance(n, ir_trees):
+                pending += reversed(n.children) # type: ignore
+            elif isinstance(n, IRToken) and n.type in ('basic_string', 'literal_string', 'ml_basic_string', 'ml_literal_string'):
+                strings.append(str(n))
+        return strings
+
+    def manifest_conditions(self, manifest: Tree[Any]) -> List[Tuple[str, str, str, Any]]:
+        "Returns the (section, key, text, node) of each *-if key in the manifest IR (see condition)"
+        conditions: List[Tuple[str, str, str, Any]] = []
+        for (section, key, val) in self.manifest_items(manifest):
+            if key is not None and key.endswith('-if'):
+                text_node: Tuple[str, Any] | None = self.condition(val)
+                if text_node is not None:
+                    conditions.append((section, key) + text_node)
+        return conditions
+
+    def condition_node(self, text: str) -> Any:
+        "Returns the mp_expr of the condition text (parsed with one continuation line for each line of text)"
+        ini: str = 'x-if =\n' + ''.join([f'  {line}\n' for line in text.splitlines()])
+        manifest: Tree[Any] | None = self.parse_ini(ini)
+        if manifest is None:
+            raise ExpressionError(f'cannot parse {text!r}')
+        return manifest.children[0].children[0].children[2].children[0] # type: ignore
+
+    def compile_condition(self, text: str, node: Any, vector: bool = False) -> Callable[[Dict[str, Any]], Any]:
+        """
+        Returns the compiled function of the condition text (see compile_mp_expr),
+        parsing it (see condition_node) if node is None
+        """
+        if node is None and text not in (compiled_vector_exprs if vector else compiled_exprs):
+            node = self.condition_node(text)
+        return compile_mp_expr(text, node, vector)
+
+    def evaluate_file(self, ini_file: str, values: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Returns the report of evaluating the *-if keys of ini_file for the
+        platform values: the value of each key in each section ('tests'),
+        which is null if the key is not a manifestparser expression ('errors')
+        """
+        report: Dict[str, Any] = {'file': ini_file, 'status': 'failed', 'tests': {}, 'errors': []}
+        ini: str | None = self.read_binary_file_as_string(os.path.join(self.topsrcdir, ini_file))
+        if ini == None:
+            report['errors'].append('cannot read file')
+            return report
+        manifest: Tree[Any] | None = self.parse_ini(ini)
+        if manifest is None:
+            report['errors'].append('cannot parse file')
+            return report
+        for (section, key, text, node) in self.manifest_conditions(manifest):
+            value: bool | None = None
+            try:
+                value = evaluate_mp_expr(self.compile_condition(text, node), values)
+            except ExpressionError as e:
+                report['errors'].append(f'[{section}] {key}: {e}')
+            report['tests'].setdefault(section, {})[key] = value
+        report['status'] = 'failed' if report['errors'] else 'passed'
+        return report
+
+    def evaluate(self, list_file: str, platform: str) -> bool:
+        """
+        Evaluates the *-if keys of each *.ini file listed in list_file for
+        the --platform values, writing the report for each file (see
+        evaluate_file), in sorted order, as one JSON object per line to
+        outfile, followed by a summary (with the number of expressions
+        compiled, as each distinct expression is only compiled once).
+        Returns True if all expressions were evaluated.
+        """
+        ini_files: List[str] | None = self.read_file_list(list_file)
+        if ini_files is None:
+            return False
+        values: Dict[str, Any] | None = self.platform_values(platform)
+        if values is None:
+            return False
+        counts: Dict[str, int] = {'passed': 0, 'failed': 0}
+        start: float = time.perf_counter()
+        for ini_file in ini_files:
+            report: Dict[str, Any] = self.evaluate_file(ini_file, values)
+            counts[report['status']] += 1
+            self.verr(f'{report["status"].upper()} {report["file"]}')
+            self.out(json.dumps(report))
+        self.out(json.dumps({'summary': counts, 'expressions': len(compiled_exprs),
+                             'seconds': round(time.perf_counter() - start, 3)}))
+        return counts['failed'] == 0
+
+    def platform_configurations(self, platform: str) -> Tuple[List[str], List[Dict[str, Any]]] | None:
+        """
+        Returns the names and values of the --platform configurations for
+        --skip-matrix: a JSON file with a list of configurations (named by
+        their index), an object of named configurations or one configuration
+        (as mozinfo.json), or comma separated name=value pairs (see
+        platform_values), or None on error
+        """
+        if not platform.endswith('.json'):
+            values: Dict[str, Any] | None = self.platform_values(platform)
+            return None if values is None else (['platform'], [values])
+        text: str | None = self.read_file_as_string(platform)
+        if text == None:
+            return None
+        try:
+            configurations: Any = json.loads(text) # type: ignore
+        except json.JSONDecodeError as e:
+            self.err(f'platform invalid: {platform}: {e}')
+            return None
+        if isinstance(configurations, list) and all([isinstance(c, dict) for c in configurations]):
+            return ([str(i) for i in range(len(configurations))], configurations)
+        if isinstance(configurations, dict) and configurations and all([isinstance(c, dict) for c in configurations.values()]):
+            return (list(configurations.keys()), list(configurations.values()))
+        if isinstance(configurations, dict):
+            return (['platform'], [configurations])
+        self.err(f'platform invalid (not a list or object of configurations): {platform}')
+        return None
+
+    def skip_matrix(self, manifest: Tree[Any], columns: Dict[str, Any], n: int) -> Tuple[List[str], Any, List[str]]:
+        """
+        Returns the tests (sections other than DEFAULT and includes) of the
+        manifest IR, the test x configuration matrix of which are skipped
+        in each of the n configurations (with the values of each variable
+        in columns, see mp_columns) and the errors. A test is skipped if
+        any skip-if (of the test or DEFAULT) is true or any run-if is false.
+        Each expression is evaluated once for all the configurations
+        """
+        tests: List[str] = [s for s in self.manifest_sections(manifest) if s != 'DEFAULT' and not s.startswith('include:')]
+        skipped: Dict[str, Any] = {section: np.zeros(n, dtype=np.bool_) for section in tests + ['DEFAULT']}
+        errors: List[str] = []
+        for (section, key, text, node) in self.manifest_conditions(manifest):
+            if section not in skipped or key not in ('skip-if', 'run-if'):
+                continue
+            try:
+                function: Callable[[Dict[str, Any]], Any] = self.compile_condition(text, node, True)
+                value: Any = evaluate_mp_expr_vector(function, columns, n)
+            except ExpressionError as e:
+                errors.append(f'[{section}] {key}: {e}')
+                continue
+            skipped[section] |= value if key == 'skip-if' else ~value
+        matrix: Any = np.zeros((len(tests), n), dtype=np.bool_)
+        for (i, test) in enumerate(tests):
+            matrix[i] = skipped[test] | skipped['DEFAULT']
+        return (tests, matrix, errors)
+
+    def skip_matrices(self, list_file: str, platform: str) -> bool:
+        """
+        Writes the names of the --platform configurations, then for each *.ini
+        file listed in list_file, in sorted order, which of its tests are
+        skipped in each configuration (see skip_matrix) as one JSON object
+        per line to outfile (a string for each test with S for skipped and
+        . for run in each configuration), followed by a summary.
+        Returns True if all expressions were evaluated.
+        """
+        if np is None:
+            self.err('--skip-matrix requires numpy')
+            return False
+        ini_files: List[str] | None = self.read_file_list(list_file)
+        if ini_files is None:
+            return False
+        configurations: Tuple[List[str], List[Dict[str, Any]]] | None = self.platform_configurations(platform)
+        if configurations is None:
+            return False
+        (names, values) = configurations
+        columns: Dict[str, Any] = mp_columns(values)
+        counts: Dict[str, int] = {'passed': 0, 'failed': 0}
+        start: float = time.perf_counter()
+        self.out(json.dumps({'configurations': names}))
+        for ini_file in ini_files:
+            report: Dict[str, Any] = {'file': ini_file, 'status': 'failed', 'skipped': {}, 'errors': []}
+            ini: str | None = self.read_binary_file_as_string(os.path.join(self.topsrcdir, ini_file))
+            manifest: Tree[Any] | None = None if ini == None else self.parse_ini(ini) # type: ignore
+            if manifest is None:
+                report['errors'].append('cannot read file')
+            else:
+                (tests, matrix, errors) = self.skip_matrix(manifest, columns, len(names))
+                for (i, test) in enumerate(tests):
+                    report['skipped'][test] = ''.join(['S' if s else '.' for s in matrix[i]])
+                report['errors'] = errors
+                report['status'] = 'failed' if errors else 'passed'
+            counts[report['status']] += 1
+            self.verr(f'{report["status"].upper()} {report["file"]}')
+            self.out(json.dumps(report))
+        self.out(json.dumps({'summary': counts, 'configurations': len(names),
+                             'expressions': len(compiled_vector_exprs),
+                             'seconds': round(time.perf_counter() - start, 3)}))
+        return counts['failed'] == 0
+
+    def store_path(self, store: str) -> str:
+        "Returns the path of the manifest store (by default for topsrcdir in the build directory)"
+        if store:
+            return store
+        self.init_build_dir()
+        h: str = hashlib.sha256(self.topsrcdir.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.build_dir, f'manifests-{h}.sqlite')
+
+    def store_digest(self) -> str:
+        "Returns the hash of what the rows of the manifest store depend on (this program, the grammars and options)"
+        h = hashlib.sha256()
+        for part in (program_digest(), self.ir_ebnf, self.ir_lalr_ebnf, str(self.fix_implicit), str(self.debug_expr)):
+            h.update(part.encode('utf-8'))
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def open_store(self, path: str, digest: str | None = None) -> sqlite3.Connection | None:
+        """
+        Returns a connection to the manifest store at path (creating the tables
+        if needed), or None on error. If digest is given (see store_digest)
+        and the store was written with a different one it is emptied
+        """
+        try:
+            if digest is not None and os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            elif digest is None and not os.path.exists(path):
+                self.err(f'store not found: {path} (see --update-store)')
+                return None
+            connection: sqlite3.Connection = sqlite3.connect(path)
+            with connection:
+                row: Tuple[str] | None = None
+                if connection.execute("SELECT name FROM sqlite_master WHERE name = 'meta'").fetchone():
+                    row = connection.execute("SELECT value FROM meta WHERE name = 'digest'").fetchone()
+                if digest is not None and (row is None or row[0] != digest):
+                    if row is not None:
+                        self.verr(f'store written by a different version, rebuilding: {path}')
+                    connection.executescript(store_schema)
+                    connection.execute("INSERT INTO meta (name, value) VALUES ('digest', ?)", (digest,))
+        except sqlite3.Error as e:
+            self.err(f'cannot open store {path}: {e}')
+            return None
+        return connection
+
+    def read_manifest(self, ini_file: str) -> Tuple[str | None, str]:
+        "Returns a tuple of (contents, hash of contents) of ini_file (relative to topsrcdir), or (None, '') on error"
+        try:
+            with open(file=os.path.join(self.topsrcdir, ini_file), mode='rb') as f: # binary to preserve CRLF
+                ini: str = f.read().decode('utf-8')
+        except (OSError, UnicodeDecodeError):
+            return (None, '')
+        return (ini, hashlib.sha256(ini.encode('utf-8')).hexdigest())
+
+    def manifest_record(self, ini_file: str) -> Dict[str, Any]:
+        """
+        Returns the record of ini_file for the manifest store: the hash of its
+        contents, the engine which parsed it, its status and for each section
+        (in order) each key with its value (as written in the INI, empty for a
+        key without a value) and the variables referenced (if a *-if key)
+        """
+        record: Dict[str, Any] = {'file': ini_file, 'sha': '', 'engine': '', 'status': 'failed', 'sections': []}
+        (ini, record['sha']) = self.read_manifest(ini_file)
+        if ini is None:
+            self.err(f'cannot read {ini_file}')
+            return record
+        manifest: Tree[Any] | None = self.parse_ini(ini)
+        if manifest is None:
+            return record
+        record['engine'] = self.parsed_engine
+        record['status'] = 'passed'
+        for (section, key, val) in self.manifest_items(manifest):
+            if key is None:
+                record['sections'].append([section, []])
+                continue
+            variables: Set[str] = set()
+            if key.endswith('-if'):
+                text_node: Tuple[str, Any] | None = self.condition(val)
+                if text_node is not None:
+                    try:
+                        node: Any = text_node[1] if text_node[1] is not None else self.condition_node(text_node[0])
+                        variables = mp_expr_variables(node)
+                    except ExpressionError:
+                        pass
+            record['sections'][-1][1].append([key, self.val_text(val), sorted(variables)])
+        return record
+
+    def store_manifest(self, connection: sqlite3.Connection, record: Dict[str, Any]) -> None:
+        "Replaces the rows of the manifest (see manifest_record) in the store"
+        self.remove_manifest(connection, record['file'])
+        manifest: int = connection.execute('INSERT INTO manifests (path, sha, engine, status) VALUES (?, ?, ?, ?)',
+                                           (record['file'], record['sha'], record['engine'], record['status'])).lastrowid # type: ignore
+        for (position, (name, keys)) in enumerate(record['sections']):
+            section: int = connection.execute('INSERT INTO sections (manifest, name, position) VALUES (?, ?, ?)',
+                                              (manifest, name, position)).lastrowid # type: ignore
+            for (key, value, variables) in keys:
+                entry: int = connection.execute('INSERT INTO entries (section, key, value) VALUES (?, ?, ?)',
+                                                (section, key, value)).lastrowid # type: ignore
+                connection.executemany('INSERT INTO variables (entry, name) VALUES (?, ?)',
+                                       [(entry, v) for v in variables])
+
+    def remove_manifest(self, connection: sqlite3.Connection, path: str) -> None:
+        "Removes the rows of the manifest at path from the store"
+        row: Tuple[int] | None = connection.execute('SELECT id FROM manifests WHERE path = ?', (path,)).fetchone()
+        if row is None:
+            return
+        sections: str = 'SELECT id FROM sections WHERE manifest = ?'
+        entries: str = f'SELECT id FROM entries WHERE section IN ({sections})'
+        connection.execute(f'DELETE FROM variables WHERE entry IN ({entries})', row)
+        connection.execute(f'DELETE FROM entries WHERE section IN ({sections})', row)
+        connection.execute('DELETE FROM sections WHERE manifest = ?', row)
+        connection.execute('DELETE FROM manifests WHERE id = ?', row)
+
+    def update_store(self, list_file: str, store: str) -> bool:
+        """
+        Updates the manifest store (see store_path) with each *.ini file listed
+        in list_file: only the files whose contents changed (by hash) are
+        parsed (with --jobs N worker processes), and files no longer listed
+        are removed. Writes a summary as one JSON object to outfile.
+        Returns True if all files were parsed.
+        """
+        ini_files: List[str] | None = self.read_file_list(list_file)
+        if ini_files is None:
+            return False
+        path: str = self.store_path(store)
+        connection: sqlite3.Connection | None = self.open_store(path, self.store_digest())
+        if connection is None:
+            return False
+        start: float = time.perf_counter()
+        stored: Dict[str, Tuple[str, str]] = {p: (sha, status) for (p, sha, status) in
+                                              connection.execute('SELECT path, sha, status FROM manifests')}
+        counts: Dict[str, int] = {'parsed': 0, 'unchanged': 0, 'removed': 0, 'failed': 0}
+        todo: List[str] = []
+        for ini_file in ini_files:
+            if ini_file in stored and stored[ini_file][0] and self.read_manifest(ini_file)[1] == stored[ini_file][0]:
+                counts['unchanged'] += 1
+                counts['failed'] += stored[ini_file][1] == 'failed'
+            else:
+                todo.append(ini_file)
+        records: Any = None
+        executor: ProcessPoolExecutor | None = None
+        if self.jobs == 1 or len(todo) < 2:
+            records = map(self.manifest_record, todo)
+        else:
+            executor = ProcessPoolExecutor(max_workers=self.jobs, initializer=init_batch_worker,
+                                           initargs=(self.batch_options(),))
+            records = executor.map(store_worker, todo, chunksize=4)
+        try:
+            with connection:
+                for record in records:
+                    counts['parsed'] += 1
+                    counts['failed'] += record['status'] == 'failed'
+                    self.verr(f'{record["status"].upper()} {record["file"]}')
+                    self.store_manifest(connection, record)
+                listed: Set[str] = set(ini_files)
+                for p in stored:
+                    if p not in listed:
+                        counts['removed'] += 1
+                        self.remove_manifest(connection, p)
+        except BrokenProcessPool as e: # a worker died
+            self.err(f'update store failed: {e}')
+            return False
+        except sqlite3.Error as e:
+            self.err(f'cannot update store {path}: {e}')
+            return False
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            connection.close()
+        self.verr(f'updated store: {path}')
+        self.out(json.dumps({'summary': counts, 'seconds': round(time.perf_counter() - start, 3)}))
+        return counts['failed'] == 0
+
+    def query_store(self, query: str, store: str) -> bool:
+        """
+        Writes each key in the manifest store (see store_path) matching all
+        the comma separated filters of query (test=, key=, variable=, file=
+        and value=, each of which may be a glob) as one JSON object per line
+        to outfile, in manifest and section order, followed by a summary.
+        Returns False if the query is invalid or the store cannot be read
+        """
+        columns: Dict[str, str] = {'test': 's.name', 'key': 'e.key', 'file': 'm.path', 'value': 'e.value',
+                                   'variable': 'v.name'}
+        conditions: List[str] = []
+        parameters: List[str] = []
+        for f in query.split(','):
+            if not f.strip():
+                continue
+            (name, sep, value) = f.partition('=')
+            name = name.strip()
+            if not sep or name not in columns:
+                self.err(f'query invalid (not one of {", ".join([c + "=" for c in columns])}): "{f}"')
+                return False
+            column: str = columns[name]
+            if name == 'variable':
+                column = 'e.id IN (SELECT v.entry FROM variables v WHERE v.name'
+            op: str = 'GLOB' if re.search(r'[*?\[]', value) else '='
+            conditions.append(f'{column} {op} ?' + (')' if name == 'variable' else ''))
+            parameters.append(value.strip() if name != 'value' else value)
+        connection: sqlite3.Connection | None = self.open_store(self.store_path(store))
+        if connection is None:
+            return False
+        start: float = time.perf_counter()
+        sql: str = 'SELECT m.path, s.name, e.key, e.value FROM entries e JOIN sections s ON e.section = s.id ' \
+            'JOIN manifests m ON s.manifest = m.id' + (' WHERE ' + ' AND '.join(conditions) if conditions else '') + \
+            ' ORDER BY m.path, s.position, e.id'
+        n: int = 0
+        try:
+            for (path, section, key, value) in connection.execute(sql, parameters):
+                n += 1
+                self.out(json.dumps({'file': path, 'section': section, 'key': key, 'value': value}))
+        except sqlite3.Error as e:
+            self.err(f'cannot query store: {e}')
+            return False
+        finally:
+            connection.close()
+        self.out(json.dumps({'summary': {'keys': n}, 'seconds': round(time.perf_counter() - start, 3)}))
         return True
 
+    def key_value(self, val: Any, toml: bool) -> str:
+        """
+        Returns the value of a key as read by manifestparser: the lines of
+        an INI value (without indentation and comments), or the strings of
+        a TOML value (one per line), empty for a key without a value
+        """
+        if val is None:
+            return ''
+        if toml:
+            strings: List[str] = self.val_strings(val)
+            if strings:
+                return '\n'.join(strings)
+        lines: List[str] = [re.sub(r'(^|[\x20\x09])#.*$', '', line).strip() for line in self.val_text(val).splitlines()]
+        return '\n'.join([line for line in lines if line])
+
+    def manifest_values(self, ini_file: str) -> Dict[str, Any] | None:
+        """
+        Returns the hash and the sections (in order, each with its key values,
+        see key_value) of ini_file (relative to topsrcdir), reusing those in the
+        resolve index if its contents did not change, or None on error
+        """
+        (ini, sha) = self.read_manifest(ini_file)
+        if ini is None:
+            return None
+        manifests: Dict[str, Any] = self.resolve_index.setdefault('manifests', {})
+        entry: Dict[str, Any] | None = manifests.get(ini_file)
+        if entry is not None and entry['sha'] == sha:
+            return entry
+        manifest: Tree[Any] | None = self.parse_ini(ini)
+        if manifest is None:
+            return None
+        entry = {'sha': sha, 'sections': []}
+        for (section, key, val) in self.manifest_items(manifest):
+            if key is None:
+                entry['sections'].append([section, {}])
+            else:
+                entry['sections'][-1][1][key] = self.key_value(val, self.read_toml)
+        manifests[ini_file] = entry
+        self.resolve_index['dirty'] = True
+        return entry
+
+    def resolve_manifest(self, ini_file: str, defaults: Dict[str, str], tests: Dict[str, Dict[str, str]],
+                         shas: Dict[str, str], errors: List[str], including: List[str]) -> None:
+        """
+        Adds the effective values of each test of ini_file to tests (by the path
+        of the test relative to the first manifest in including): defaults
+        combined with the keys of DEFAULT, combined with those of the test
+        (see combine_fields). The tests of each included manifest are
+        resolved with the values of its include section as defaults.
+        Adds the hash of each manifest read to shas
+        """
+        entry: Dict[str, Any] | None = self.manifest_values(ini_file)
+        if entry is None:
+            errors.append(f'cannot read {ini_file}')
+            return
+        shas[ini_file] = entry['sha']
+        root: str = os.path.dirname(including[0]) if including else os.path.dirname(ini_file)
+        prefix: str = os.path.relpath(os.path.dirname(ini_file) or '.', root or '.')
+        for (section, values) in entry['sections']:
+            if section == 'DEFAULT':
+                defaults = combine_fields(defaults, values)
+                continue
+            combined: Dict[str, str] = combine_fields(defaults, values)
+            if section.startswith('include:'):
+                include: str = os.path.normpath(os.path.join(os.path.dirname(ini_file), section[len('include:'):].strip()))
+                if include in including or include == ini_file:
+                    errors.append(f'include cycle: {" -> ".join(including + [ini_file, include])}')
+                else:
+                    self.resolve_manifest(include, combined, tests, shas, errors, including + [ini_file])
+            else:
+                tests[os.path.normpath(os.path.join(prefix, section))] = combined
+
+    def resolve_file(self, ini_file: str) -> Dict[str, Any]:
+        """
+        Returns the report of the effective values of each test of ini_file
+        (see resolve_manifest), reusing the report in the resolve index
+        if neither ini_file nor any manifest it includes changed
+        """
+        resolved: Dict[str, Any] = self.resolve_index.setdefault('resolved', {})
+        report: Dict[str, Any] | None = resolved.get(ini_file)
+        if report is not None and all([self.read_manifest(p)[1] == sha for (p, sha) in report['shas'].items()]):
+            return dict(report, cached=True)
+        tests: Dict[str, Dict[str, str]] = {}
+        shas: Dict[str, str] = {}
+        errors: List[str] = []
+        self.resolve_manifest(ini_file, {}, tests, shas, errors, [])
+        report = {'file': ini_file, 'status': 'failed' if errors else 'passed', 'tests': tests,
+                  'includes': sorted([p for p in shas if p != ini_file]), 'errors': errors, 'shas': shas}
+        if not errors:
+            resolved[ini_file] = report
+            self.resolve_index['dirty'] = True
+        return dict(report, cached=False)
+
+    def load_resolve_index(self) -> None:
+        """
+        Loads the resolve index for topsrcdir from the build directory
+        (an index written by a different version of mmp.py is ignored)
+        """
+        self.resolve_index = {}
+        if not self.cache:
+            return
+        try:
+            with open(file=self.resolve_index_path(), mode='r', encoding='utf-8') as f:
+                index: Dict[str, Any] = json.load(f)
+        except (OSError, ValueError):
+            return
+        if index.get('program') == self.store_digest() and index.get('version') == resolve_version \
+           and index.get('topsrcdir') == self.topsrcdir:
+            self.resolve_index = {'manifests': index['manifests'], 'resolved': index['resolved']}
+            self.verr(f'loaded resolve index: {self.resolve_index_path()}')
+
+    def save_resolve_index(self) -> None:
+        "Saves the resolve index (if anything changed)"
+        if not self.cache or not self.resolve_index.get('dirty'):
+            return
+        index: Dict[str, Any] = {'program': self.store_digest(), 'version': resolve_version, 'topsrcdir': self.topsrcdir,
+                                 'manifests': self.resolve_index.get('manifests', {}),
+                                 'resolved': self.resolve_index.get('resolved', {})}
+        index_path: str = self.resolve_index_path()
+        try:
+            os.makedirs(self.build_dir, exist_ok=True)
+            tmp_path: str = f'{index_path}.{os.getpid()}.tmp'
+            with open(file=tmp_path, mode='w', encoding='utf-8') as f:
+                json.dump(index, f)
+            os.replace(tmp_path, index_path)
+        except OSError as e:
+            self.verr(f'cannot save resolve index {index_path}: {e}')
+            return
+        self.verr(f'saved resolve index: {index_path}')
+
+    def resolve_index_path(self) -> str:
+        "Returns the path of the resolve index for topsrcdir"
+        self.init_build_dir()
+        h: str = hashlib.sha256(self.topsrcdir.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.build_dir, f'resolve-{h}.json')
+
+    def resolve(self, list_file: str) -> bool:
+        """
+        Writes the effective values of each test of each *.ini file listed
+        in list_file (see resolve_file), in sorted order, as one JSON object
+        per line to outfile, followed by a summary (with the number of
+        files which were resolved from the resolve index).
+        Returns True if all files (and their includes) were read.
+        """
+        ini_files: List[str] | None = self.read_file_list(list_file)
+        if ini_files is None:
+            return False
+        self.load_resolve_index()
+        counts: Dict[str, int] = {'passed': 0, 'failed': 0}
+        cached: int = 0
+        start: float = time.perf_counter()
+        for ini_file in ini_files:
+            report: Dict[str, Any] = self.resolve_file(os.path.normpath(ini_file))
+            counts[report['status']] += 1
+            cached += report['cached']
+            self.verr(f'{report["status"].upper()} {report["file"]}')
+            self.out(json.dumps({k: report[k] for k in ('file', 'status', 'tests', 'includes', 'errors')}))
+        self.save_resolve_index()
+        self.out(json.dumps({'summary': counts, 'cached': cached, 'seconds': round(time.perf_counter() - start, 3)}))
+        return counts['failed'] == 0
+
+# MetaManifestParser for this batch worker process
+batch_mmp: MetaManifestParser | None = None
+
+def init_batch_worker(options: Dict[str, Any]) -> None:
+    "Creates the MetaManifestParser for a batch worker process"
+    global batch_mmp
+    batch_mmp = MetaManifestParser(**options)
+
+def batch_worker(ini_file: str, output_dir: str | None, ini_output_dir: str | None) -> Tuple[bool, str]:
+    "Converts one file in a batch worker process"
+    return batch_mmp.batch_convert(ini_file, output_dir, ini_output_dir) # type: ignore
+
+def verify_worker(ini_file: str) -> Dict[str, Any]:
+    "Verifies one file in a batch worker process"
+    return batch_mmp.verify_file(ini_file) # type: ignore
+
+def store_worker(ini_file: str) -> Dict[str, Any]:
+    "Returns the manifest store record of one file in a batch worker process"
+    return batch_mmp.manifest_record(ini_file) # type: ignore
+
 if __name__ == "__main__":
     sys.exit(MetaManifestParser().run())